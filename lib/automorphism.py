@@ -1,14 +1,46 @@
+import numpy as np
+
+from lib.ring import array_to_poly, poly_to_array
+
+
+# X^j -> X^(j * (2l/k + 1)^power) as a gather: coefficient j of the image is
+# x[src[j]], negated where neg[j]. One table per power in range(k)
+def phi_tables(d, l, k):
+    phi_index = 2 * l // k + 1
+    tables = []
+    for power in range(k):
+        p = np.arange(d, dtype=np.int64) * phi_index**power
+        dst = p % d
+        src = np.empty(d, dtype=np.int64)
+        src[dst] = np.arange(d)
+        neg = np.empty(d, dtype=bool)
+        neg[dst] = (p // d) % 2 == 1
+        src.flags.writeable = False
+        neg.flags.writeable = False
+        tables.append((src, neg))
+    return tuple(tables)
+
+
+def get_phi_tables(PP):
+    key = (PP.d, PP.l, PP.k)
+    tables = _phi_tables.get(key)
+    if tables is None:
+        tables = _phi_tables.setdefault(key, phi_tables(PP.d, PP.l, PP.k))
+    return tables
+
+
+_phi_tables = {}
+
+
+# applies phi to every polynomial of an array of shape (..., d)
+def phi_arr(PP, a, power):
+    src, neg = get_phi_tables(PP)[power % PP.k]
+    res = a[..., src]
+    return np.where(neg, (PP.q - res) % PP.q, res)
+
+
 def phi(PP, x, power):
-    if power < 0:
-        power += PP.k
-    phi_index = 2 * PP.l // PP.k + 1
-    res = 0
-    for j, coef in enumerate(x):
-        p = j * phi_index**power
-        sign = (-1) ** ((p // PP.d) % 2)
-        newpower = p % PP.d
-        res += coef * sign * PP.X ** (newpower)
-    return res
+    return array_to_poly(PP, phi_arr(PP, poly_to_array(PP, x), power))
 
 
 if __name__ == "__main__":
@@ -26,3 +58,5 @@ if __name__ == "__main__":
     poly, _ = random_poly(PP, seed, 0, PP.d)
     assert poly == phi(PP, phi(PP, poly, 1), -1)
     assert poly == phi(PP, phi(PP, phi(PP, poly, 1), -3), 2)
+    batch = np.stack(list(poly_to_array(PP, poly * X**i) for i in range(3)))
+    assert phi(PP, poly * X, 1) == array_to_poly(PP, phi_arr(PP, batch, 1)[1])
@@ -1,5 +1,13 @@
-from lib.linear_alg import matrix_vector, scalar
-from lib.random_polynomials import chi_poly
+import numpy as np
+
+from lib.linear_alg import (from_array, matrix_vector_arr, matrix_vector_ntt,
+                            to_array)
+from lib.random_polynomials import chi_poly, chi_poly_arr
+from lib.ring import ntt
+from lib.ring_array import RingArray, coeffs, evals
+
+# number of randomness vectors transformed at once in commit_batch
+COMMIT_BATCH_CHUNK = 64
 
 
 def commit(PP, B0, b, m, r_seed, nonce):
@@ -8,9 +16,47 @@ def commit(PP, B0, b, m, r_seed, nonce):
     return t0, t1, r, nonce
 
 
+# B0, b and r may be given as arrays (see linear_alg.to_array)
 def commit_with_r(PP, B0, b, m, r):
-    t0 = matrix_vector(B0, r, PP.X, PP.d)
+    r = to_array(PP, r)
+    t0 = from_array(PP, matrix_vector_arr(PP, to_array(PP, B0), r))
+    bt = from_array(PP, matrix_vector_arr(PP, to_array(PP, b[: PP.npoly]), r))
     t1 = []
     for i in range(PP.npoly):
-        t1.append(scalar(b[i], r, PP.X, PP.d) + m[i])
+        t1.append(bt[i] + m[i])
     return t0, t1
+
+
+# Commits to messages M[i] with randomness R[i] as one product B0 * [r_1 ... r_n].
+# Returns T0, T1 with T0[i], T1[i] equal to commit_with_r(PP, B0, b, M[i], R[i]),
+# or with ntt_form as RingArrays (n, kappa, d) and (n, npoly, d) in NTT form.
+# B0, b and M may also be given as RingArrays
+def commit_batch(PP, B0, b, M, R, ntt_form=False):
+    ctx = PP.ring_ctx
+    B0 = evals(PP, B0)
+    b = evals(PP, b[: PP.npoly])
+    R = coeffs(PP, R)
+    T0 = []
+    T1 = []
+    for start in range(0, len(R), COMMIT_BATCH_CHUNK):
+        r = ntt(ctx, R[start : start + COMMIT_BATCH_CHUNK])
+        T0.append(matrix_vector_ntt(PP, B0, r))
+        T1.append(matrix_vector_ntt(PP, b, r))
+    T0 = RingArray(PP, evals=np.concatenate(T0))
+    T1 = RingArray(PP, evals=np.concatenate(T1)) + RingArray(PP, evals=evals(PP, M))
+    if ntt_form:
+        return T0, T1
+    return T0.to_polys(), T1.to_polys()
+
+
+# Fresh randomness R (n, baselen, d) for n commitments with B0 * r and
+# b * r in NTT form: the part of the commitments that does not depend on
+# the messages
+def commitment_randomness(PP, B0, b, n):
+    ctx = PP.ring_ctx
+    R, _ = chi_poly_arr(PP, n * PP.baselen, PP.rng.randombytes(PP.seedlen), 0)
+    R = R.reshape(n, PP.baselen, PP.d)
+    r = ntt(ctx, R)
+    B0r = matrix_vector_ntt(PP, evals(PP, B0), r)
+    br = matrix_vector_ntt(PP, evals(PP, b[: PP.npoly]), r)
+    return R, B0r, br
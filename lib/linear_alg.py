@@ -1,6 +1,7 @@
+import numpy as np
 from sage.all import *
 
-from lib.ring import signed_zq
+from lib.ring import intt, mod_matmul, ntt, ntt_mul, poly_to_array
 
 
 def vector_mult_by_scalar(vect, s):
@@ -28,83 +29,282 @@ def matrix_matrix(A, X):
     m = len(A)
     n = len(A[0])
     l = len(X[0])
-    assert len(X) == m
+    assert len(X) == n
     res = []
     for i in range(m):
         row = [0] * l
         for j in range(l):
             for k in range(n):
-                row[j] = A[i][k] * X[k][j]
+                row[j] += A[i][k] * X[k][j]
         res.append(row)
     return res
 
 
+# Coefficient-level kernels over centered representatives in (-q/2, q/2].
+# Polynomials, vectors and matrices may be given as Sage objects or as
+# int64 arrays (see to_array); arrays avoid per-coefficient conversions.
+
+# rows of d coefficients checked at once by the early-exit bound checks
+NORM_CHUNK = 16
+
+_EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def _poly_coeffs(z):
+    if isinstance(z, np.ndarray):
+        return z.reshape(-1)
+    return np.array(list(int(coef) for coef in z), dtype=np.int64)
+
+
+def _vect_coeffs(Z):
+    if isinstance(Z, np.ndarray):
+        return Z.reshape(-1)
+    return np.concatenate(list(_poly_coeffs(val) for val in Z) + [_EMPTY])
+
+
+def _matr_coeffs(Z):
+    if isinstance(Z, np.ndarray):
+        return Z.reshape(-1)
+    return np.concatenate(list(_vect_coeffs(row) for row in Z) + [_EMPTY])
+
+
+def _pairs_coeffs(pairs):
+    xs = [_EMPTY]
+    ys = [_EMPTY]
+    for x, y in pairs:
+        x, y = _poly_coeffs(x), _poly_coeffs(y)
+        n = min(len(x), len(y))
+        xs.append(x[:n])
+        ys.append(y[:n])
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+def centered(a, q):
+    a = np.asarray(a, dtype=np.int64) % q
+    return np.where(a > (q - 1) // 2, a - q, a)
+
+
+def centered_abs(a, q):
+    a = np.asarray(a, dtype=np.int64) % q
+    return np.minimum(a, q - a)
+
+
+# exact sum of int64 values below 2^62 in absolute value as python ints
+def exact_sum(a, axis=None):
+    hi = (a >> 31).sum(axis=axis).astype(object)
+    lo = (a & 0x7FFFFFFF).sum(axis=axis).astype(object)
+    return hi * 2**31 + lo
+
+
+def scalar_zz(a, b, q):
+    return exact_sum(centered(a, q) * centered(b, q))
+
+
 def scalar_vector_zz(a, b, q):
-    n = len(a)
-    res = 0
-    for i in range(n):
-        for coef_a, coef_b in zip(a[i], b[i]):
-            res += signed_zq(coef_a, q) * signed_zq(coef_b, q)
-    return res
+    if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+        return scalar_zz(a, b, q)
+    return scalar_zz(*_pairs_coeffs(zip(a, b)), q)
 
 
 def scalar_matrix_zz(A, B, q):
+    if isinstance(A, np.ndarray) and isinstance(B, np.ndarray):
+        return scalar_zz(A, B, q)
     m, n = A.dimensions()
-    res = 0
-    for i in range(m):
-        for j in range(n):
-            for coef_a, coef_b in zip(A[i][j], B[i][j]):
-                res += signed_zq(coef_a, q) * signed_zq(coef_b, q)
-    return res
+    pairs = ((A[i][j], B[i][j]) for i in range(m) for j in range(n))
+    return scalar_zz(*_pairs_coeffs(pairs), q)
 
 
 def inf_norm(z, q):
-    res = 0
-    for coef in z:
-        coef = signed_zq(coef, q)
-        if abs(coef) > res:
-            res = abs(coef)
-    return res
+    return int(centered_abs(_poly_coeffs(z), q).max(initial=0))
 
 
 def inf_norm_vect(Z, q):
-    res = 0
-    for val in Z:
-        norm = inf_norm(val, q)
-        if norm > res:
-            res = norm
-    return res
+    return int(centered_abs(_vect_coeffs(Z), q).max(initial=0))
 
 
 def inf_norm_matr(Z, q):
-    res = 0
-    for row in Z:
-        for val in row:
-            norm = inf_norm(val, q)
-            if norm > res:
-                res = norm
-    return res
+    return int(centered_abs(_matr_coeffs(Z), q).max(initial=0))
 
 
-def l2_norm(x, get_q):
-    res = 0
-    for coef in x:
-        res += signed_zq(coef, q) ** 2
-    return sqrt(res)
+def l2_norm_sq(a, q, axis=None):
+    a = centered(a, q)
+    return exact_sum(a * a, axis)
+
+
+def l2_norm_sq_vect(Z, q):
+    return l2_norm_sq(_vect_coeffs(Z), q)
+
+
+def l2_norm_sq_matr(Z, q):
+    return l2_norm_sq(_matr_coeffs(Z), q)
+
+
+def l2_norm(x, q):
+    return sqrt(l2_norm_sq(_poly_coeffs(x), q))
 
 
 def l2_norm_vect(Z, q):
-    res = 0
-    for val in Z:
-        for coef in val:
-            res += signed_zq(coef, q) ** 2
-    return sqrt(res)
+    return sqrt(l2_norm_sq_vect(Z, q))
 
 
 def l2_norm_matr(Z, q):
-    res = 0
-    for row in Z:
-        for val in row:
-            for coef in val:
-                res += signed_zq(coef, q) ** 2
-    return sqrt(res)
+    return sqrt(l2_norm_sq_matr(Z, q))
+
+
+# True as soon as a coefficient of a has centered absolute value >= bound
+def exceeds_inf_bound(a, q, bound):
+    a = a.reshape(-1, a.shape[-1])
+    for i in range(0, len(a), NORM_CHUNK):
+        if (centered_abs(a[i : i + NORM_CHUNK], q) >= bound).any():
+            return True
+    return False
+
+
+# True as soon as the running squared l2 norm of a exceeds max_sq
+def exceeds_l2_bound(a, q, max_sq):
+    a = a.reshape(-1, a.shape[-1])
+    norm = 0
+    for i in range(0, len(a), NORM_CHUNK):
+        norm += l2_norm_sq(a[i : i + NORM_CHUNK], q)
+        if norm > max_sq:
+            return True
+    return False
+
+
+# Z of shape (rows, columns, d); True at the first column whose squared
+# l2 norm exceeds max_sq
+def exceeds_l2_bound_columns(Z, q, max_sq):
+    for j in range(Z.shape[1]):
+        if exceeds_l2_bound(Z[:, j], q, max_sq):
+            return True
+    return False
+
+
+# Vectors and matrices of ring elements as int64 arrays of shape (..., d)
+# with coefficients in [0, q). Products are computed in NTT form.
+
+
+def to_array(PP, x):
+    if isinstance(x, np.ndarray):
+        return x
+    if isinstance(x, (list, tuple)):
+        return np.stack(list(to_array(PP, v) for v in x))
+    return poly_to_array(PP, x)
+
+
+def from_array(PP, a, ring=None):
+    if ring is None:
+        ring = PP.P
+    if a.ndim == 1:
+        return ring(list(int(v) for v in a))
+    return list(from_array(PP, v, ring) for v in a)
+
+
+def mul_arr(PP, a, b):
+    ctx = PP.ring_ctx
+    return intt(ctx, ntt_mul(ctx, ntt(ctx, a), ntt(ctx, b)))
+
+
+def scalar_arr(PP, a, b):
+    ctx = PP.ring_ctx
+    return intt(ctx, ntt_mul(ctx, ntt(ctx, a), ntt(ctx, b)).sum(axis=-2) % PP.q)
+
+
+def matrix_vector_arr(PP, A, x):
+    ctx = PP.ring_ctx
+    return intt(ctx, matrix_vector_ntt(PP, ntt(ctx, A), ntt(ctx, x)))
+
+
+# A and x already in NTT form, x may hold a batch of vectors (..., n, d)
+def matrix_vector_ntt(PP, A, x):
+    x = x[..., np.newaxis, :, :]
+    return ntt_mul(PP.ring_ctx, A, x).sum(axis=-2) % PP.q
+
+
+# number of inner-dimension entries of ring_matmul transformed at once
+RING_MATMUL_BLOCK = 1024
+
+
+# A (m, n, d) times B (n, k, d) over R, given as coefficient arrays or
+# RingArrays. Blocks of A's columns and B's rows are taken in NTT form (a
+# RingArray is transformed at most once), multiplied and accumulated in NTT
+# form; the result is transformed back once
+def ring_matmul(PP, A, B, block=RING_MATMUL_BLOCK):
+    ctx = PP.ring_ctx
+    n = A.shape[1]
+    assert B.shape[0] == n
+    res = np.zeros((A.shape[0], B.shape[1], PP.d), dtype=np.int64)
+    for start in range(0, n, block):
+        A_blk = _block_evals(ctx, A[:, start : start + block])
+        B_blk = _block_evals(ctx, B[start : start + block])
+        res = (res + ring_matmul_ntt(PP, A_blk, B_blk)) % PP.q
+    return intt(ctx, res)
+
+
+# A is either a coefficient array or a ring_array.RingArray
+def _block_evals(ctx, A):
+    if isinstance(A, np.ndarray):
+        return ntt(ctx, A)
+    return A.evals
+
+
+# A (m, n, d) times B (n, k, d), both and the result in NTT form, n < 2^17
+def ring_matmul_ntt(PP, A, B):
+    ctx = PP.ring_ctx
+    q, l, s = PP.q, ctx.l, ctx.s
+    m, n, k = A.shape[0], A.shape[1], B.shape[1]
+    # residue index first: (l, s, m, n) and (l, s, n, k)
+    A = A.reshape(m, n, l, s).transpose(2, 3, 0, 1)
+    B = B.reshape(n, k, l, s).transpose(2, 3, 0, 1)
+    C = np.zeros((l, 2 * s - 1, m, k), dtype=np.int64)
+    for i in range(s):
+        for j in range(s):
+            C[:, i + j] = (C[:, i + j] + mod_matmul(A[:, i], B[:, j], q)) % q
+    hi = C[:, s:] * ctx.moduli.reshape(-1, 1, 1, 1) % q
+    C = C[:, :s]
+    C[:, : s - 1] = (C[:, : s - 1] + hi) % q
+    return C.transpose(2, 3, 0, 1).reshape(m, k, PP.d)
+
+
+# Sparse challenges. Multiplying by X^e is a negacyclic rotation: with
+# a_ext = (a, -a) coefficient i of X^e * a is a_ext[(i - e) mod 2d], which
+# also covers X^d = -1. Products with sparse challenges are gathers and
+# additions only.
+
+
+def _negacyclic_ext(a, q):
+    a = np.asarray(a, dtype=np.int64)
+    return np.concatenate((a, (q - a) % q), axis=-1)
+
+
+# c * a for a ternary c (coefficients -1, 0, 1, possibly given as q - 1) and
+# a of shape (..., d): signed sum of rotations of a
+def ternary_mul(PP, c, a):
+    q, d = PP.q, PP.d
+    c = centered(np.asarray(c, dtype=np.int64), q)
+    nz = np.flatnonzero(c)
+    idx = (np.arange(d) - nz.reshape(-1, 1)) % (2 * d)
+    rot = _negacyclic_ext(a, q)[..., idx]
+    return (rot * c[nz].reshape(-1, 1)).sum(axis=-2) % q
+
+
+# A (m, n, d) times an n x k matrix C of signed monomials in packed form:
+# C[i, j] = 0 for a zero entry and +-(e + 1) for +-X^e, see
+# random_polynomials.challenge_amo_packed. Row i of C and column i of A
+# are rotated on the fly, the memory besides the result is O(m k d)
+def monomial_matmul(PP, A, C):
+    q, d = PP.q, PP.d
+    assert A.shape[1] == C.shape[0]
+    res = np.zeros((A.shape[0], C.shape[1], d), dtype=np.int64)
+    for i in range(C.shape[0]):
+        c = C[i].astype(np.int64)
+        exps = np.maximum(np.abs(c) - 1, 0)
+        idx = (np.arange(d) - exps.reshape(-1, 1)) % (2 * d)
+        # |res| < n * q < 2^62
+        res += _negacyclic_ext(A[:, i], q)[:, idx] * np.sign(c).reshape(-1, 1)
+    return res % q
+
+
+# matrix whose columns are the given vectors of ring elements
+def columns_to_array(PP, vectors):
+    return np.swapaxes(to_array(PP, vectors), 0, 1)
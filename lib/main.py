@@ -1,5 +1,5 @@
 from lib.params import PublicParams
-from lib.utils import max_with_index, reset_all
+from lib.utils import max_with_index
 from lib.voting_classes import BBoard
 from lib.voting_scheme import tally_all, tally_j, testballots, verify, vote
 
@@ -1,7 +1,13 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil
 
 from sage.all import *
 
+from lib.public import gen_public_b_arr
+from lib.ring import get_ring_context
+from lib.utils import RejectionSampler, SystemRandomness
+
 
 def _ceil_float(x, pos):
     factor = 10**pos
@@ -9,7 +15,15 @@ def _ceil_float(x, pos):
 
 
 class PublicParams:
-    def __init__(self, Na, Nc, Nv_max):
+    def __init__(
+        self,
+        Na,
+        Nc,
+        Nv_max,
+        public_b_version=0,
+        challenge_amo_version=0,
+        rng=None,
+    ):
         self.Na = Na
         self.Nc = Nc
         self.Nv_max = Nv_max
@@ -45,6 +59,8 @@ class PublicParams:
         self.commit_len = self.npoly + 2
         self.baselen = self.lamb + self.kappa + self.commit_len
         self.u = 30
+        # nonce schedule of the public matrices, see public.public_b_nonces
+        self.public_b_version = public_b_version
 
         alpha = 11 * self.k
         self.average_rejection_tries1 = e ** (12 / alpha + 1 / (2 * alpha**2))
@@ -53,12 +69,18 @@ class PublicParams:
         )
         self.sigma1 = alpha * sqrt(theta_1 * self.baselen * self.d**2 * self.Na)
         self.beta1 = self.sigma1 * sqrt(2 * self.baselen * self.d)
+        # largest accepted squared l2 norm of a VProof z: ||z|| < beta1
+        self.l2_bound1_sq = int(ceil(self.beta1**2)) - 1
         self.inf_bound1 = 2 ** (ceil(log(6 * self.sigma1, 2))) - 1
+        self.rejection1 = RejectionSampler(self.sigma1, self.average_rejection_tries1)
 
         self.seedlen = 32
 
         self.amo_sec_param = 128
         self.amo_n = math.ceil((self.amo_sec_param + 2) / math.log(2 * self.d + 1))
+        # word filter of the amortized challenges, see
+        # random_polynomials.challenge_amo_packed
+        self.challenge_amo_version = challenge_amo_version
         p = self.number_of_authority_commitments(Nv_max)
 
         self.average_rejection_tries2 = 3
@@ -68,10 +90,38 @@ class PublicParams:
         theta_2 = _ceil_float(theta_2, 3)
         self.sigma2 = 11 * sqrt(theta_2 * self.baselen * self.amo_n * self.d * p)
         self.beta2 = self.sigma2 * sqrt(2 * self.baselen * self.d)
+        # largest accepted squared l2 norm of a column of the amortized Z
+        self.l2_bound2_sq = int(floor(self.beta2**2))
         self.inf_bound2 = 2 ** (ceil(log(6 * self.sigma2, 2))) - 1
+        self.rejection2 = RejectionSampler(self.sigma2, self.average_rejection_tries2)
 
         self.beta_commit_infty = 1
 
+        # source of all randomness, see utils.SystemRandomness
+        self.rng = SystemRandomness() if rng is None else rng
+
+        self._ring_ctx = None
+
+    # NTT tables and CRT basis of R, built once on first use
+    @property
+    def ring_ctx(self):
+        if self._ring_ctx is None:
+            self._ring_ctx = get_ring_context(
+                self.q, self.d, self.l, self.k, int(self.zeta)
+            )
+        return self._ring_ctx
+
+    # arguments of PublicParams that rebuild these parameters, e.g. in
+    # worker processes
+    def worker_args(self):
+        return (
+            int(self.Na),
+            int(self.Nc),
+            int(self.Nv_max),
+            int(self.public_b_version),
+            int(self.challenge_amo_version),
+        )
+
     def number_of_authority_commitments(self, n):
         p = n
         u_power = self.u
@@ -81,5 +131,48 @@ class PublicParams:
         return p
 
 
+# Worker processes that hold PublicParams and the public matrices of one
+# seed, built once in the initializer and not per task. There is one pool
+# per name, started on first use and kept while the parameters, the seed
+# and the number of processes stay the same.
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+_worker_PP = None
+_worker_public_seed = None
+
+
+def worker_pool(name, PP, public_seed, processes):
+    key = (PP.worker_args(), bytes(public_seed), processes)
+    with _worker_pools_lock:
+        pool, pool_key = _worker_pools.get(name, (None, None))
+        if pool_key != key:
+            if pool is not None:
+                pool.shutdown()
+            pool = ProcessPoolExecutor(
+                processes, initializer=_init_worker, initargs=key[:2]
+            )
+            _worker_pools[name] = (pool, key)
+        return pool
+
+
+def shutdown_worker_pool(name):
+    with _worker_pools_lock:
+        pool, _ = _worker_pools.pop(name, (None, None))
+    if pool is not None:
+        pool.shutdown()
+
+
+def _init_worker(args, public_seed):
+    global _worker_PP, _worker_public_seed
+    _worker_PP = PublicParams(*args)
+    _worker_public_seed = public_seed
+    gen_public_b_arr(_worker_PP, public_seed)
+
+
+# (PP, public_seed) in a process of worker_pool
+def worker_params():
+    return _worker_PP, _worker_public_seed
+
+
 if __name__ == "__main__":
     PP = PublicParams(2, 5, 10)
@@ -0,0 +1,121 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+from lib.commit import commitment_randomness
+from lib.proof_amo import amo_mask
+from lib.public import gen_public_b_arr
+
+
+# Offline part of an authority's tally. Background threads fill two
+# bounded queues while the authority is idle: masks (Y, B0 * Y, b * Y) of
+# the amortized proofs and randomness of the tree commitments with
+# B0 * r, b * r (see commit.commitment_randomness). Every item is handed
+# out once; when a queue is empty the item is computed on the spot, so the
+# pool never changes what is proven, only when the work is done.
+class ProverPool:
+    def __init__(
+        self, PP, public_seed, masks=8, commitments=256, max_bytes=None, workers=1
+    ):
+        self.PP = PP
+        self.public_seed = public_seed
+        B0, b = gen_public_b_arr(PP, public_seed)
+        self.B0 = B0
+        self.b = b[: PP.npoly]
+        rows = PP.baselen + PP.kappa + PP.npoly
+        self.mask_bytes = 8 * PP.d * PP.amo_n * rows
+        self.commitment_bytes = 8 * PP.d * rows
+        if max_bytes is not None:
+            # half of the memory for each queue
+            masks = min(masks, max_bytes // 2 // self.mask_bytes)
+            commitments = min(commitments, max_bytes // 2 // self.commitment_bytes)
+        self.max_masks = masks
+        self.max_commitments = commitments
+        self.workers = workers
+        self._masks = deque()
+        self._commitments = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._threads = list(
+            threading.Thread(target=self._fill, daemon=True)
+            for _ in range(self.workers)
+        )
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                while self._running and self._missing() is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                queue = self._missing()
+            if queue is self._masks:
+                item = self._new_mask()
+            else:
+                item = self._new_commitments(1)
+            with self._cond:
+                limit = self.max_masks if queue is self._masks else self.max_commitments
+                if len(queue) < limit:
+                    queue.append(item)
+
+    # the queue to fill next, masks first
+    def _missing(self):
+        if len(self._masks) < self.max_masks:
+            return self._masks
+        if len(self._commitments) < self.max_commitments:
+            return self._commitments
+        return None
+
+    def _new_mask(self):
+        return amo_mask(self.PP, self.B0, self.b)
+
+    def _new_commitments(self, n):
+        return commitment_randomness(self.PP, self.B0, self.b, n)
+
+    def _pop(self, queue, n):
+        with self._cond:
+            items = list(queue.popleft() for _ in range(min(n, len(queue))))
+            self._cond.notify_all()
+        return items
+
+    # (Y, W0, W1) for proof_amo and proof_amo_to_zero
+    def mask(self, public_seed):
+        assert public_seed == self.public_seed
+        items = self._pop(self._masks, 1)
+        if items:
+            return items[0]
+        return self._new_mask()
+
+    # randomness R (n, baselen, d) of n commitments with B0 * r (n, kappa, d)
+    # and b * r (n, npoly, d) in NTT form
+    def commitments(self, public_seed, n):
+        assert public_seed == self.public_seed
+        items = self._pop(self._commitments, n)
+        if len(items) < n:
+            items.append(self._new_commitments(n - len(items)))
+        return tuple(np.concatenate(x) for x in zip(*items))
@@ -1,29 +1,36 @@
-from Crypto.Hash import SHAKE128
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
 from sage.all import *
 
 from lib.commit import commit
-from lib.linear_alg import inf_norm_matr, matrix_vector, scalar
-from lib.public import gen_public_b
-from lib.random_polynomials import (challenge_amo, chi_poly,
-                                    discrete_gaussian_y, random_poly)
-from lib.ring import signed_zq
-from lib.utils import poly_to_bytes, randombytes, rejection_sampling_matrix
+from lib.linear_alg import (columns_to_array, exceeds_inf_bound,
+                            exceeds_l2_bound_columns, monomial_matmul,
+                            ring_matmul)
+from lib.params import (PublicParams, shutdown_worker_pool, worker_params,
+                        worker_pool)
+from lib.public import gen_public_b_arr
+from lib.random_polynomials import (challenge_amo_packed, chi_poly,
+                                    discrete_gaussian_y_arr, random_poly)
+from lib.ring import ntt
+from lib.ring_array import RingArray, coeffs
+from lib.utils import (DeterministicRandomness, SystemRandomness, Transcript,
+                       rejection_sampling_matrix)
 
 
 def get_challenge_hash_amo(PP, T, W, p):
-    shake = SHAKE128.new()
-    for i in range(PP.kappa):
-        for j in range(p):
-            shake.update(poly_to_bytes(T[i][j]))
-    for i in range(PP.kappa):
-        for j in range(PP.amo_n):
-            shake.update(poly_to_bytes(W[i][j]))
-    c_hash = shake.read(int(PP.seedlen))
+    transcript = Transcript()
+    transcript.absorb_array(coeffs(PP, T[: PP.kappa, :p]))
+    transcript.absorb_array(W[: PP.kappa, : PP.amo_n])
+    c_hash = transcript.read(PP.seedlen)
     return c_hash
 
 
 def get_challenge_amo(PP, c_hash, p):
-    return challenge_amo(PP, c_hash, p)
+    return challenge_amo_packed(PP, c_hash, p)
 
 
 # def check_Z_len_infty(Z):
@@ -79,23 +86,27 @@ def get_challenge_amo(PP, c_hash, p):
 
 
 def check_Z_len(PP, Z):
-    norm = [0] * PP.amo_n
-    for row in Z:
-        for j, val in enumerate(row):
-            for coef in val:
-                norm[j] += signed_zq(coef, PP.q) ** 2
-
-    for i in range(PP.amo_n):
-        norm[i] = sqrt(norm[i])
-        if norm[i] > PP.beta2:
-            return 1
+    if exceeds_l2_bound_columns(Z, PP.q, PP.l2_bound2_sq):
+        return 1
+    return 0
+
+
+# 1 unless Z is a (baselen, amo_n, d) array; a Z of another shape would
+# broadcast against T * C or make the products fail
+def check_Z_shape(PP, Z):
+    try:
+        shape = np.shape(Z)
+    except ValueError:
+        return 1
+    if shape != (PP.baselen, PP.amo_n, PP.d):
+        return 1
     return 0
 
 
 def gen_randomness_matrix(PP, p):
     R = PP.R
 
-    r_seed = randombytes(PP.seedlen)
+    r_seed = PP.rng.randombytes(PP.seedlen)
     S = []
     for i in range(p):
         r = chi_poly(PP.baselen, r_seed, i)
@@ -103,42 +114,205 @@ def gen_randomness_matrix(PP, p):
     return Matrix(R, S).transpose()
 
 
-def proof_amo(PP, S, T, p, public_seed):
-    R = PP.R
+# mask Y of an amortized proof with W0 = B0 * Y and W1 = b * Y (None
+# without b), Y is transformed to NTT form once for both products
+def amo_mask(PP, B0, b=None):
+    Y = discrete_gaussian_y_arr(PP, PP.baselen, PP.amo_n, PP.sigma2)
+    Y_ntt = RingArray(PP, coeffs=Y, evals=ntt(PP.ring_ctx, Y))
+    W0 = ring_matmul(PP, B0, Y_ntt)
+    W1 = None if b is None else ring_matmul(PP, b, Y_ntt)
+    return Y, W0, W1
 
-    B0, b = gen_public_b(PP, public_seed)
-    while True:
-        Y = discrete_gaussian_y(PP, PP.baselen, PP.amo_n, PP.sigma2)
-        W = Matrix(R, B0) * Y
 
-        c_hash = get_challenge_hash_amo(PP, T, W, p)
-        C = get_challenge_amo(PP, c_hash, p)
-        C = Matrix(R, C)
-        SC = S * C
-        Z = Y + SC
-        if (
-            rejection_sampling_matrix(
-                Z, SC, PP.sigma2, PP.average_rejection_tries2, PP.q
-            )
-            and inf_norm_matr(Z, PP.q) < PP.inf_bound2
-        ):
-            break
+# One attempt of proof_amo (T1 is None) or proof_amo_to_zero with the mask
+# (Y, W0, W1): returns (c_hash, Z) and "accepted", or None and the reason
+# of the rejection ("inf_bound" or "rejected"). If stopped() is true before
+# the product with the challenges, the attempt gives up with "discarded".
+def _amo_attempt(PP, S, T0, T1, p, mask, rng, stopped=None):
+    q = PP.q
 
-    return (c_hash, Z)
+    Y, W0, W1 = mask
+    if T1 is None:
+        c_hash = get_challenge_hash_amo(PP, T0, W0, p)
+        C = get_challenge_amo(PP, c_hash, p)
+    else:
+        c_hash = get_challenge_hash_amo_to_zero(PP, T0, T1, W0, W1, p)
+        C = get_challenge_amo_to_zero(PP, c_hash, p)
+    if stopped is not None and stopped():
+        return None, "discarded"
+    SC = monomial_matmul(PP, S, C)
+    Z = (Y + SC) % q
+    if exceeds_inf_bound(Z, q, PP.inf_bound2):
+        return None, "inf_bound"
+    if not rejection_sampling_matrix(Z, SC, PP.rejection2, q, rng):
+        return None, "rejected"
+    return (c_hash, Z), "accepted"
+
+
+# Attempts of both provers, one after another or, with
+# set_amo_attempt_processes(n) for n > 1 and without a pool, speculatively
+# with n attempts at a time in worker processes. The proof is the first
+# accepted attempt in attempt order, not in order of completion, so it is
+# distributed exactly like the first accepted one of independent attempts
+# made one after another. Every attempt gets its own randomness, see
+# _attempt_seed. If stats is a list, one record per attempt is appended to
+# it: the proof, the attempt number, its outcome ("accepted", "inf_bound",
+# "rejected", or "discarded" for attempts after the accepted one) and the
+# seconds the attempt took (None if it never started).
+def _prove_amo(PP, name, S, T0, T1, p, public_seed, pool, stats):
+    S = coeffs(PP, S)
+    if pool is None and _amo_attempt_processes > 1:
+        return _prove_amo_parallel(PP, name, S, T0, T1, p, public_seed, stats)
+
+    B0, b = gen_public_b_arr(PP, public_seed)
+    b = None if T1 is None else b[: PP.npoly]
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        if pool is None:
+            mask = amo_mask(PP, B0, b)
+        else:
+            mask = pool.mask(public_seed)
+        res, outcome = _amo_attempt(PP, S, T0, T1, p, mask, PP.rng)
+        _record_attempt(stats, name, attempt, outcome, time.perf_counter() - start)
+        if res is not None:
+            return res
+        attempt += 1
+
+
+def _record_attempt(stats, name, attempt, outcome, seconds):
+    if stats is not None:
+        stats.append(
+            {"proof": name, "attempt": attempt, "outcome": outcome, "seconds": seconds}
+        )
+
+
+# S, T0 and T1 are saved once per proof as .npy files in a temporary
+# directory which the workers map (np.load with mmap_mode), so an attempt
+# only sends the directory and its seed. Once the proof is decided, a stop
+# file in the directory makes the attempts still running give up.
+def _prove_amo_parallel(PP, name, S, T0, T1, p, public_seed, stats):
+    n = _amo_attempt_processes
+    executor = worker_pool("amo_attempt", PP, public_seed, n)
+    with tempfile.TemporaryDirectory(prefix="kmzi-amo-") as directory:
+        np.save(os.path.join(directory, "S.npy"), S)
+        np.save(os.path.join(directory, "T0.npy"), coeffs(PP, T0))
+        if T1 is not None:
+            np.save(os.path.join(directory, "T1.npy"), coeffs(PP, T1))
+
+        base_seed = _base_seed(PP)
+        running = {}
+        results = {}
+        submitted = 0
+        decided = 0
+        res = None
+        while res is None:
+            while len(running) < n:
+                seed = _attempt_seed(PP, base_seed, submitted)
+                f = executor.submit(
+                    _amo_attempt_job, directory, T1 is not None, p, seed
+                )
+                running[f] = submitted
+                submitted += 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                results[running.pop(f)] = f.result()
+            # attempts are decided in attempt order
+            while res is None and decided in results:
+                res, outcome, seconds = results.pop(decided)
+                _record_attempt(stats, name, decided, outcome, seconds)
+                decided += 1
+
+        open(os.path.join(directory, "stop"), "w").close()
+        for f in running:
+            if f.cancel():
+                results[running[f]] = (None, "discarded", None)
+        for f in wait(running).done:
+            if running[f] not in results:
+                results[running[f]] = f.result()
+        for attempt in sorted(results):
+            _record_attempt(stats, name, attempt, "discarded", results[attempt][2])
+    return res
+
+
+# Randomness of the attempts in the workers: None if PP.rng is the CSPRNG
+# of the OS, which the workers then use themselves. Otherwise one base seed
+# is drawn from PP.rng per proof and attempt i gets SHAKE128(base seed || i),
+# so the draws from PP.rng do not depend on how many attempts were started
+# before the proof was decided and a run with a DeterministicRandomness
+# stays reproducible.
+def _base_seed(PP):
+    if isinstance(PP.rng, SystemRandomness):
+        return None
+    return PP.rng.randombytes(PP.seedlen)
+
+
+def _attempt_seed(PP, base_seed, attempt):
+    if base_seed is None:
+        return None
+    transcript = Transcript()
+    transcript.absorb(base_seed)
+    transcript.absorb(attempt.to_bytes(8, byteorder="big"))
+    return transcript.read(PP.seedlen)
+
+
+_amo_attempt_processes = 1
+
+
+# Number of worker processes for the attempts of proof_amo and
+# proof_amo_to_zero, see params.worker_pool
+def set_amo_attempt_processes(n):
+    global _amo_attempt_processes
+    _amo_attempt_processes = n
+    shutdown_worker_pool("amo_attempt")
+
+
+# one attempt in a worker process: (result, outcome, seconds)
+def _amo_attempt_job(directory, to_zero, p, seed):
+    start = time.perf_counter()
+    stop = os.path.join(directory, "stop")
+
+    def stopped():
+        return os.path.exists(stop)
+
+    if stopped():
+        return None, "discarded", time.perf_counter() - start
+    PP, public_seed = worker_params()
+    if seed is None:
+        PP.rng = SystemRandomness()
+    else:
+        PP.rng = DeterministicRandomness(seed)
+    S = np.load(os.path.join(directory, "S.npy"), mmap_mode="r")
+    T0 = np.load(os.path.join(directory, "T0.npy"), mmap_mode="r")
+    T1 = None
+    if to_zero:
+        T1 = np.load(os.path.join(directory, "T1.npy"), mmap_mode="r")
+    B0, b = gen_public_b_arr(PP, public_seed)
+    b = b[: PP.npoly] if to_zero else None
+    mask = amo_mask(PP, B0, b)
+    res, outcome = _amo_attempt(PP, S, T0, T1, p, mask, PP.rng, stopped)
+    return res, outcome, time.perf_counter() - start
+
+
+# S (baselen, p, d) and T (kappa, p, d) are arrays (see linear_alg.to_array)
+# or ring_array.RingArrays. Masks are taken from pool (see
+# precompute.ProverPool) when given; see _prove_amo for stats
+def proof_amo(PP, S, T, p, public_seed, pool=None, stats=None):
+    return _prove_amo(PP, "amo", S, T, None, p, public_seed, pool, stats)
 
 
 def verify_amo(PP, proof, T, p, public_seed):
-    R = PP.R
-
     c_hash, Z = proof
+    if check_Z_shape(PP, Z):
+        return 1
     C = get_challenge_amo(PP, c_hash, p)
-    C = Matrix(R, C)
-    B0, b = gen_public_b(PP, public_seed)
+    B0, b = gen_public_b_arr(PP, public_seed)
 
     if check_Z_len(PP, Z):
         return 1
 
-    W = Matrix(R, B0) * Z - T * C
+    TC = monomial_matmul(PP, coeffs(PP, T), C)
+    W = (ring_matmul(PP, B0, Z) - TC) % PP.q
     c_hash_prime = get_challenge_hash_amo(PP, T, W, p)
     if c_hash != c_hash_prime:
         return 1
@@ -146,65 +320,38 @@ def verify_amo(PP, proof, T, p, public_seed):
 
 
 def get_challenge_hash_amo_to_zero(PP, T0, T1, W0, W1, p):
-    shake = SHAKE128.new()
-    for i in range(PP.kappa):
-        for j in range(p):
-            shake.update(poly_to_bytes(T0[i][j]))
-    for i in range(PP.npoly):
-        for j in range(p):
-            shake.update(poly_to_bytes(T1[i][j]))
-    for i in range(PP.kappa):
-        for j in range(PP.amo_n):
-            shake.update(poly_to_bytes(W0[i][j]))
-    for i in range(PP.npoly):
-        for j in range(PP.amo_n):
-            shake.update(poly_to_bytes(W1[i][j]))
-    c_hash = shake.read(int(PP.seedlen))
+    transcript = Transcript()
+    transcript.absorb_array(coeffs(PP, T0[: PP.kappa, :p]))
+    transcript.absorb_array(coeffs(PP, T1[: PP.npoly, :p]))
+    transcript.absorb_array(W0[: PP.kappa, : PP.amo_n])
+    transcript.absorb_array(W1[: PP.npoly, : PP.amo_n])
+    c_hash = transcript.read(PP.seedlen)
     return c_hash
 
 
 def get_challenge_amo_to_zero(PP, c_hash, p):
-    return challenge_amo(PP, c_hash, p)
-
-
-def proof_amo_to_zero(PP, S, T0, T1, p, public_seed):
-    R = PP.R
-
-    B0, b = gen_public_b(PP, public_seed)
-    while True:
-        Y = discrete_gaussian_y(PP, PP.baselen, PP.amo_n, PP.sigma2)
-        W0 = Matrix(R, B0) * Y
-        W1 = Matrix(R, list(vector(R, b[i]) * Y for i in range(PP.npoly)))
+    return challenge_amo_packed(PP, c_hash, p)
 
-        c_hash = get_challenge_hash_amo_to_zero(PP, T0, T1, W0, W1, p)
-        C = get_challenge_amo_to_zero(PP, c_hash, p)
-        C = Matrix(R, C)
-        SC = S * C
-        Z = Y + SC
-        if (
-            rejection_sampling_matrix(
-                Z, SC, PP.sigma2, PP.average_rejection_tries2, PP.q
-            )
-            and inf_norm_matr(Z, PP.q) < PP.inf_bound2
-        ):
-            break
 
-    return (c_hash, Z)
+def proof_amo_to_zero(PP, S, T0, T1, p, public_seed, pool=None, stats=None):
+    return _prove_amo(PP, "amo_to_zero", S, T0, T1, p, public_seed, pool, stats)
 
 
 def verify_amo_to_zero(PP, proof, T0, T1, p, public_seed):
-    R = PP.R
+    q = PP.q
 
     c_hash, Z = proof
+    if check_Z_shape(PP, Z):
+        return 1
     C = get_challenge_amo_to_zero(PP, c_hash, p)
-    C = Matrix(R, C)
-    B0, b = gen_public_b(PP, public_seed)
+    B0, b = gen_public_b_arr(PP, public_seed)
+    b = b[: PP.npoly]
 
     if check_Z_len(PP, Z):
         return 1
 
-    W0 = Matrix(R, B0) * Z - T0 * C
-    W1 = Matrix(R, list(vector(R, b[i]) * Z - T1[i] * C for i in range(PP.npoly)))
+    W0 = (ring_matmul(PP, B0, Z) - monomial_matmul(PP, coeffs(PP, T0), C)) % q
+    W1 = (ring_matmul(PP, b, Z) - monomial_matmul(PP, coeffs(PP, T1), C)) % q
 
     c_hash_prime = get_challenge_hash_amo_to_zero(PP, T0, T1, W0, W1, p)
     if c_hash != c_hash_prime:
@@ -213,12 +360,10 @@ def verify_amo_to_zero(PP, proof, T0, T1, p, public_seed):
 
 
 def _gen_random_commitments_impl(PP, p, public_seed, m_func):
-    R = PP.R
-
-    B0, b = gen_public_b(PP, public_seed)
+    B0, b = gen_public_b_arr(PP, public_seed)
 
-    r_seed = randombytes(PP.seedlen)
-    seed = randombytes(PP.seedlen)
+    r_seed = PP.rng.randombytes(PP.seedlen)
+    seed = PP.rng.randombytes(PP.seedlen)
     S = []
     T0 = []
     T1 = []
@@ -233,9 +378,9 @@ def _gen_random_commitments_impl(PP, p, public_seed, m_func):
         T0.append(t0)
         T1.append(t1)
     return (
-        Matrix(R, S).transpose(),
-        Matrix(R, T0).transpose(),
-        Matrix(R, T1).transpose(),
+        columns_to_array(PP, S),
+        columns_to_array(PP, T0),
+        columns_to_array(PP, T1),
     )
 
 
@@ -248,8 +393,6 @@ def gen_random_commitments_to_zero(PP, p, public_seed):
 
 
 if __name__ == "__main__":
-    from params import PublicParams
-
     public_seed = b"\xf3\xe0\xf0\n\x17\x02\xd3\xee\xd3\xbd{D\xff\x19\xf5b\x98\xca\xdf\xc0M\xe8\x12\xbe\xc3\xc4a1\xd6\xe1\xf2\xba"
 
     PP = PublicParams(2, 5, 10)
@@ -262,6 +405,10 @@ if __name__ == "__main__":
         print("Verify amo is successfull")
     else:
         print("There is an error in verification amo")
+    # a single column, a missing row and a ragged Z are rejected
+    c_hash, Z = proof
+    for bad_Z in (Z[:, :1], Z[:-1], list(Z[:-1]) + [Z[-1][:-1]]):
+        assert verify_amo(PP, (c_hash, bad_Z), T0, p, public_seed) == 1
     S, T0, T1 = gen_random_commitments_to_zero(PP, p - Nv, public_seed)
     amo_zero_proof = proof_amo_to_zero(PP, S, T0, T1, p - Nv, public_seed)
     ver_result_zero = verify_amo_to_zero(
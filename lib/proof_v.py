@@ -1,53 +1,49 @@
-from Crypto.Hash import SHAKE128
-
-from lib.automorphism import phi
-from lib.linear_alg import (inf_norm_matr, l2_norm_vect, matrix_vector, scalar,
-                            vector_mult_by_scalar)
-from lib.public import gen_public_b_with_extra
-from lib.random_polynomials import (challenge, discrete_gaussian_vector_y,
+import numpy as np
+
+from lib.automorphism import phi_arr
+from lib.linear_alg import (exceeds_inf_bound, exceeds_l2_bound, from_array,
+                            matrix_vector_arr, matrix_vector_ntt, mul_arr,
+                            ring_matmul, scalar_arr, ternary_mul, to_array)
+from lib.public import gen_public_b_arr
+from lib.random_polynomials import (challenge, challenge_arr,
+                                    discrete_gaussian_vector_y_arr,
                                     random_poly, random_poly_with_zeros,
-                                    random_zq)
-from lib.ring import INTT
-from lib.utils import poly_to_bytes, randombytes, rejection_sampling_vector
+                                    random_polys_arr, random_zq)
+from lib.ring import INTT, intt, ntt
+from lib.utils import Transcript, randombytes, rejection_sampling_vector
 
 
+# W (k, kappa, d) is hashed like the elements of R it stands for; alpha is
+# returned as a (k, npoly, d) array
 def get_alpha_gamma(PP, t0, t1, t2, W):
     k = PP.k
 
-    shake = SHAKE128.new()
-    for i in range(PP.kappa):
-        shake.update(poly_to_bytes(t0[i]))
-    for i in range(PP.npoly):
-        shake.update(poly_to_bytes(t1[i]))
-    shake.update(poly_to_bytes(t2))
-    for i in range(k):
-        for j in range(PP.kappa):
-            shake.update(poly_to_bytes(W[i][j]))
-    ag_hash = shake.read(int(PP.seedlen))
+    transcript = Transcript()
+    transcript.absorb_polys(t0[: PP.kappa])
+    transcript.absorb_polys(t1[: PP.npoly])
+    transcript.absorb_polys([t2])
+    transcript.absorb_array(W)
+    ag_hash = transcript.read(PP.seedlen)
     nonce = 0
     if k == 1:
         gamma, _ = random_poly(PP, ag_hash, nonce, PP.d // PP.l)
         return gamma, ag_hash
     else:
-        alpha = [0] * (k * PP.npoly)
-        for i in range(k * PP.npoly):
-            alpha[i], nonce = random_poly(PP, ag_hash, nonce, PP.d)
+        alpha, nonce = random_polys_arr(PP, ag_hash, nonce, k * PP.npoly, PP.d)
+        alpha = alpha.reshape(k, PP.npoly, PP.d)
         gamma, nonce = random_zq(PP, ag_hash, nonce, k)
         return alpha, gamma, ag_hash
 
 
+# vpp (d) and vulp (d) or (k, d) are arrays of elements of R
 def get_challenge_hash(PP, gamma_hash, t3, vpp, h, vulp):
-    shake = SHAKE128.new()
-    shake.update(gamma_hash)
-    shake.update(poly_to_bytes(t3))
-    shake.update(poly_to_bytes(vpp))
-    shake.update(poly_to_bytes(h))
-    if PP.k == 1:
-        shake.update(poly_to_bytes(vulp))
-    else:
-        for i in range(PP.k):
-            shake.update(poly_to_bytes(vulp[i]))
-    c_hash = shake.read(int(PP.seedlen))
+    transcript = Transcript()
+    transcript.absorb(gamma_hash)
+    transcript.absorb_polys([t3])
+    transcript.absorb_array(vpp)
+    transcript.absorb_polys([h])
+    transcript.absorb_array(vulp)
+    c_hash = transcript.read(PP.seedlen)
     return c_hash
 
 
@@ -57,26 +53,21 @@ def get_challenge(PP, c_hash):
 
 def check_z_len(PP, Z):
     for z in Z:
-        if l2_norm_vect(z, PP.q) >= PP.beta1:
+        if exceeds_l2_bound(z, PP.q, PP.l2_bound1_sq):
             return 1
     return 0
 
 
 def _compute_single_z(PP, y, c, r):
-    z = [0] * PP.baselen
-    cr = [0] * PP.baselen
-    for i in range(PP.baselen):
-        cr[i] = (c * r[i]).mod(PP.X**PP.d + 1)
-        z[i] = (y[i] + cr[i]).mod(PP.X**PP.d + 1)
-    if (
-        rejection_sampling_vector(z, cr, PP.sigma1, PP.average_rejection_tries1, PP.q)
-        == 0
-    ):
+    cr = ternary_mul(PP, c, r)
+    z = (y + cr) % PP.q
+    if rejection_sampling_vector(z, cr, PP.rejection1, PP.q, PP.rng) == 0:
         return None, 1
     return z, 0
 
 
 def _compute_z(PP, Y, c, r):
+    c = to_array(PP, c)
     Z = [0] * PP.k
     for i in range(PP.k):
         z, res_ok = _compute_single_z(PP, Y[i], c, r)
@@ -84,8 +75,8 @@ def _compute_z(PP, Y, c, r):
             return None, res_ok
         Z[i] = z
         if PP.k != 1:
-            c = phi(PP, c, 1)
-    return Z, 0
+            c = phi_arr(PP, c, 1)
+    return np.stack(Z), 0
 
 
 def _compute_m_prime(PP):
@@ -97,208 +88,179 @@ def _compute_m_prime(PP):
     return m_prime
 
 
-def proof_v(PP, t0, t1, r, m, public_seed):
+# masks Y[i] of proof_v with W[i] = B0 * Y[i] and bY[i, j] = b[j] * Y[i],
+# b_ntt is b in NTT form
+def v_mask(PP, B0, b_ntt):
+    ctx = PP.ring_ctx
+    Y = [0] * PP.k
+    for i in range(PP.k):
+        Y[i] = discrete_gaussian_vector_y_arr(PP, PP.baselen, PP.sigma1)
+    Y = np.stack(Y)
+    bY = intt(ctx, matrix_vector_ntt(PP, b_ntt, ntt(ctx, Y)))
+    return Y, matrix_vector_arr(PP, B0, Y), bY
+
+
+# Part of proof_v that does not depend on the message: g, t2 and `masks`
+# masks of v_mask. Masks are used at most once, proof_v draws new ones when
+# they run out
+def prepare_proof_v(PP, r, public_seed, masks=0):
+    B0, b = gen_public_b_arr(PP, public_seed)
+    seed = PP.rng.randombytes(PP.seedlen)
+    g, _ = random_poly_with_zeros(PP, seed, 0, PP.d, PP.g_zeros)
+    t2 = from_array(PP, scalar_arr(PP, b[PP.npoly], to_array(PP, r))) + g
+    b_ntt = ntt(PP.ring_ctx, b)
+    return g, t2, list(v_mask(PP, B0, b_ntt) for _ in range(masks))
+
+
+# G = sum over mu of X^mu * d * gamma[mu] / k and Gamma = sum over mu of
+# X^mu * gamma[mu]: sum over mu of X^mu / k * sum over nu of
+# phi(d * gamma[mu] * a - gamma[mu], nu) is G * _phi_sum(a) - Gamma
+def _gamma_arr(PP, gamma):
+    q, k = PP.q, PP.k
+    k_inv = pow(k, -1, q)
+    G = np.zeros(PP.d, dtype=np.int64)
+    G[:k] = list(int(PP.d * gamma[mu]) % q * k_inv % q for mu in range(k))
+    Gamma = np.zeros(PP.d, dtype=np.int64)
+    Gamma[:k] = list(int(gamma[mu]) % q for mu in range(k))
+    return G, Gamma
+
+
+# sum of phi(a, nu) over nu
+def _phi_sum(PP, a):
+    return sum(phi_arr(PP, a, nu) for nu in range(PP.k)) % PP.q
+
+
+# sum over i and j of alpha[i, j] * phi(a[i, j], -i)
+def _alpha_sum(PP, alpha, a):
+    res = 0
+    for i in range(PP.k):
+        res = res + mul_arr(PP, alpha[i], phi_arr(PP, a[i], -i)).sum(axis=0)
+    return res % PP.q
+
+
+# vulp[i] = G * (sum over nu and j of phi(bz[i - nu, j], nu)) + bz[i, npoly]
+# for bz[i, j] = b[j] * z[i]
+def _vulp_arr(PP, G, bz):
+    k, q = PP.k, PP.q
+    bz_sum = bz[:, : PP.npoly].sum(axis=1) % q
+    vulp = np.empty((k, PP.d), dtype=np.int64)
+    for i in range(k):
+        phi_bz = sum(phi_arr(PP, bz_sum[(i - nu) % k], nu) for nu in range(k)) % q
+        vulp[i] = (mul_arr(PP, G, phi_bz) + bz[i, PP.npoly]) % q
+    return vulp
+
+
+# Everything that does not change between attempts (products with r and
+# m, sums of automorphisms of m) is computed before the rejection loop;
+# the products b[j] * Y[i] come with the mask (see v_mask), computed
+# offline for prepared masks, and are reused. The transcript is the same as computing every term
+# of the protocol on its own, the sums only use linearity of the products
+# and of phi.
+def proof_v(PP, t0, t1, r, m, public_seed, prepared=None):
     d = PP.d
     l = PP.l
     X = PP.X
     k = PP.k
     npoly = PP.npoly
 
+    R = PP.R
+    q = PP.q
+    ctx = PP.ring_ctx
+
     m_prime = _compute_m_prime(PP)
-    B0, b = gen_public_b_with_extra(PP, public_seed)
-    seed = randombytes(PP.seedlen)
-    nonce = 0
-    g, nonce = random_poly_with_zeros(PP, seed, nonce, d, PP.g_zeros)
-    t2 = scalar(b[npoly], r, X, d) + g
+    B0, b = gen_public_b_arr(PP, public_seed)
+    b_ntt = ntt(ctx, b)
+    r = to_array(PP, r)
+    if prepared is None:
+        prepared = prepare_proof_v(PP, r, public_seed)
+    g, t2, masks = prepared
+
+    br = scalar_arr(PP, b[npoly + 1], r)
+    if k == 1:
+        br = from_array(PP, br)
+        cm = 2 * m[0] - m_prime[0]
+    else:
+        cm = to_array(PP, list(2 * m[j] - m_prime[j] for j in range(npoly)))
+        phi_m = _phi_sum(PP, to_array(PP, sum(m[j] for j in range(npoly))))
+        g_arr = to_array(PP, g)
+
     while True:
-        Y = [0] * k
-        W = [0] * k
-        for i in range(PP.k):
-            Y[i] = discrete_gaussian_vector_y(PP, PP.baselen, PP.sigma1)
-            W[i] = matrix_vector(B0, Y[i], X, d)
+        if masks:
+            Y, W, bY = masks.pop()
+        else:
+            Y, W, bY = v_mask(PP, B0, b_ntt)
 
         if k == 1:
             # PP.npoly should be 1
-            y = Y[0]
             gamma, ag_hash = get_alpha_gamma(PP, t0, t1, t2, W)
-            t3 = (
-                scalar(b[npoly + 1], r, X, d)
-                - (2 * m[0] - m_prime[0]) * scalar(b[0], y, X, d)
-            ).mod(X**d + 1)
-            vpp = (scalar(b[npoly + 1], y, X, d) + scalar(b[0], y, X, d) ** 2).mod(
-                X**d + 1
-            )
+            by = from_array(PP, bY[0, 0], R)
+            t3 = (br - cm * by).mod(X**d + 1)
+            vpp = (bY[0, npoly + 1] + mul_arr(PP, bY[0, 0], bY[0, 0])) % q
             intt_factor = gamma * l
             h = (g + intt_factor * m[0] - gamma).mod(X**d + 1)
-            vulp = scalar(
-                list((intt_factor * b[0][i] + b[npoly][i]) for i in range(PP.baselen)),
-                y,
-                X,
-                d,
-            )
+            vulp = (mul_arr(PP, to_array(PP, intt_factor), bY[0, 0]) + bY[0, npoly]) % q
         else:
             alpha, gamma, ag_hash = get_alpha_gamma(PP, t0, t1, t2, W)
-            t3 = scalar(b[npoly + 1], r, X, d)
-            vpp = scalar(b[npoly + 1], Y[0], X, d)
-            for i in range(k):
-                for j in range(npoly):
-                    t3 -= (
-                        alpha[i * npoly + j]
-                        * phi(
-                            PP,
-                            ((2 * m[j] - m_prime[j]) * scalar(b[j], Y[i], X, d)).mod(
-                                X**d + 1
-                            ),
-                            -i,
-                        )
-                    ).mod(X**d + 1)
-                    vpp += (
-                        alpha[i * npoly + j]
-                        * phi(PP, (scalar(b[j], Y[i], X, d) ** 2).mod(X**d + 1), -i)
-                    ).mod(X**d + 1)
-            h = g
-            for mu in range(k):
-                coef = X**mu / k
-                coef_inner = 0
-                for nu in range(k):
-                    coef_inner += phi(
-                        PP,
-                        (
-                            d * gamma[mu] * sum(m[j] for j in range(npoly)) - gamma[mu]
-                        ).mod(X**d + 1),
-                        nu,
-                    )
-                h += (coef * coef_inner).mod(X**d + 1)
-            vulp = [0] * k
-            for i in range(k):
-                for mu in range(k):
-                    coef = X**mu / k
-                    coef_inner = 0
-                    for nu in range(k):
-                        for j in range(npoly):
-                            coef_inner += phi(
-                                PP,
-                                scalar(
-                                    vector_mult_by_scalar(b[j], d * gamma[mu]),
-                                    Y[(i - nu) % k],
-                                    X,
-                                    d,
-                                ),
-                                nu,
-                            )
-                    vulp[i] += (coef * coef_inner).mod(X**d + 1)
-                vulp[i] += scalar(b[npoly], Y[i], X, d)
+            by = bY[:, :npoly]
+            t3 = from_array(PP, (br - _alpha_sum(PP, alpha, mul_arr(PP, cm, by))) % q)
+            vpp = (bY[0, npoly + 1] + _alpha_sum(PP, alpha, mul_arr(PP, by, by))) % q
+            G, Gamma = _gamma_arr(PP, gamma)
+            h = from_array(PP, (g_arr + mul_arr(PP, G, phi_m) - Gamma) % q)
+            vulp = _vulp_arr(PP, G, bY)
 
         c_hash = get_challenge_hash(PP, ag_hash, t3, vpp, h, vulp)
         c = get_challenge(PP, c_hash)
 
         Z, res_ok = _compute_z(PP, Y, c, r)
-        if res_ok == 0 and inf_norm_matr(Z, PP.q) < PP.inf_bound1:
+        if res_ok == 0 and not exceeds_inf_bound(Z, q, PP.inf_bound1):
             break
-    return (h, c_hash, Z), (t2, t3)
+    return (h, c_hash, from_array(PP, Z, R)), (t2, t3)
 
 
-def verify_v(PP, proof, commitment, additional_com, public_seed):
+# verify_v of one proof given B0 * z[i] (k, kappa, d), b * z[i]
+# (k, commit_len, d), the challenge c (d) and m_prime (npoly, d)
+def _verify_v_products(PP, proof, commitment, additional_com, B0z, bz, c, m_prime):
     d = PP.d
     l = PP.l
-    X = PP.X
     k = PP.k
     npoly = PP.npoly
+    q = PP.q
 
-    m_prime = _compute_m_prime(PP)
-    B0, b = gen_public_b_with_extra(PP, public_seed)
-    h, c_hash, Z = proof
-    c = get_challenge(PP, c_hash)
+    h, c_hash, _ = proof
     t0, t1 = commitment
     t2, t3 = additional_com
-    if check_z_len(PP, Z):
-        return 1
-    W = [0] * k
-    f1 = [0] * k
-    f2 = [0] * k
-    for i in range(k):
-        B0z = matrix_vector(B0, Z[i], X, d)
-        w = [0] * PP.kappa
-        for j in range(PP.kappa):
-            w[j] = (B0z[j] - c * t0[j]).mod(X**d + 1)
-        W[i] = w
-
-        f1[i] = list(
-            (scalar(b[j], Z[i], X, d) - c * t1[j]).mod(X**d + 1) for j in range(npoly)
-        )
-        f2[i] = list(
-            (scalar(b[j], Z[i], X, d) - c * (t1[j] - m_prime[j])).mod(X**d + 1)
-            for j in range(npoly)
-        )
-        if k != 1:
-            c = phi(PP, c, 1)
-
-    f3 = (scalar(b[npoly + 1], Z[0], X, d) - c * t3).mod(X**d + 1)
     hlist = h.list()
     for i in range(PP.g_zeros):
         if hlist[i] != 0:
             return 1
+    t0_arr = to_array(PP, t0)
+    t1_arr = to_array(PP, t1)
+    # c[i] = phi(c, i)
+    c = list(phi_arr(PP, c, i) for i in range(k))
+    W = np.empty((k, PP.kappa, d), dtype=np.int64)
+    f = np.empty((k, npoly, d), dtype=np.int64)
+    for i in range(k):
+        W[i] = (B0z[i] - ternary_mul(PP, c[i], t0_arr)) % q
+        f1 = (bz[i, :npoly] - ternary_mul(PP, c[i], t1_arr)) % q
+        f2 = (f1 + ternary_mul(PP, c[i], m_prime)) % q
+        f[i] = mul_arr(PP, f1, f2)
+    f3 = (bz[0, npoly + 1] - ternary_mul(PP, c[0], to_array(PP, t3))) % q
+
     if k == 1:
         # PP.npoly should be 1
         gamma, ag_hash = get_alpha_gamma(PP, t0, t1, t2, W)
-        vpp = (f1[0][0] * f2[0][0] + f3).mod(X**d + 1)
-        intt_factor = l * gamma
-        tau = (intt_factor * sum(t1[i] for i in range(npoly)) - gamma).mod(X**d + 1)
-        vulp = (
-            scalar(
-                list(
-                    (intt_factor * sum(b[j][i] for j in range(npoly)) + b[npoly][i])
-                    for i in range(PP.baselen)
-                ),
-                Z[0],
-                X,
-                d,
-            )
-            - c * (tau + t2 - h)
-        ).mod(X**d + 1)
+        vpp = (f[0, 0] + f3) % q
+        intt_factor = to_array(PP, l * gamma)
+        tau = mul_arr(PP, intt_factor, t1_arr.sum(axis=0)) - to_array(PP, gamma)
+        vulp = mul_arr(PP, intt_factor, bz[0, :npoly].sum(axis=0)) + bz[0, npoly]
     else:
         alpha, gamma, ag_hash = get_alpha_gamma(PP, t0, t1, t2, W)
-        vpp = f3
-        for i in range(k):
-            for j in range(npoly):
-                vpp += (
-                    alpha[i * npoly + j]
-                    * phi(PP, (f1[i][j] * f2[i][j]).mod(X**d + 1), -i)
-                ).mod(X**d + 1)
-        tau = 0
-        for mu in range(k):
-            coef = X**mu / k
-            coef_inner = 0
-            for nu in range(k):
-                coef_inner += phi(
-                    PP,
-                    (d * gamma[mu] * sum(t1[j] for j in range(npoly)) - gamma[mu]).mod(
-                        X**d + 1
-                    ),
-                    nu,
-                )
-            tau += (coef * coef_inner).mod(X**d + 1)
-        vulp = [0] * k
-        for i in range(k):
-            for mu in range(k):
-                coef = X**mu / k
-                coef_inner = 0
-                for nu in range(k):
-                    for j in range(npoly):
-                        coef_inner += phi(
-                            PP,
-                            scalar(
-                                vector_mult_by_scalar(b[j], d * gamma[mu]),
-                                Z[(i - nu) % k],
-                                X,
-                                d,
-                            ),
-                            nu,
-                        )
-                vulp[i] += (coef * coef_inner).mod(X**d + 1)
-            vulp[i] += scalar(b[npoly], Z[i], X, d)
-            vulp[i] -= (c * (tau + t2 - h)).mod(X**d + 1)
-            c = phi(PP, c, 1)
+        vpp = (f3 + _alpha_sum(PP, alpha, f)) % q
+        G, Gamma = _gamma_arr(PP, gamma)
+        tau = mul_arr(PP, G, _phi_sum(PP, t1_arr.sum(axis=0))) - Gamma
+        vulp = _vulp_arr(PP, G, bz)
+    e = (tau + to_array(PP, t2) - to_array(PP, h)) % q
+    vulp = (vulp - np.stack(list(ternary_mul(PP, c[i], e) for i in range(k)))) % q
 
     c_hash_prime = get_challenge_hash(PP, ag_hash, t3, vpp, h, vulp)
     if c_hash != c_hash_prime:
@@ -306,10 +268,60 @@ def verify_v(PP, proof, commitment, additional_com, public_seed):
     return 0
 
 
+# Z of a proof as a (k, baselen, d) array, None for any other shape
+def _z_array(PP, Z):
+    try:
+        z = to_array(PP, Z)
+    except ValueError:
+        return None
+    if z.shape != (PP.k, PP.baselen, PP.d):
+        return None
+    return z
+
+
+# verify_v of many statements (proof, commitment, additional_com) at once:
+# B0 and b are multiplied with the vectors z of all proofs in one ring
+# matrix product and all challenges are expanded together. Returns the
+# result of verify_v for every statement
+def verify_v_batch(PP, statements, public_seed):
+    d = PP.d
+    k = PP.k
+    kappa = PP.kappa
+
+    res = [1] * len(statements)
+    idx = []
+    Z = []
+    for n, (proof, _, _) in enumerate(statements):
+        z = _z_array(PP, proof[2])
+        if z is not None and not check_z_len(PP, z):
+            idx.append(n)
+            Z.append(z)
+    if not idx:
+        return res
+
+    B0, b = gen_public_b_arr(PP, public_seed)
+    # one column for every z[i] of every proof
+    Z = np.stack(Z).reshape(-1, PP.baselen, d).swapaxes(0, 1)
+    BZ = ring_matmul(PP, np.concatenate((B0, b)), Z)
+    BZ = BZ.swapaxes(0, 1).reshape(len(idx), k, kappa + PP.commit_len, d)
+    C = challenge_arr(PP, list(statements[n][0][1] for n in idx))
+    m_prime = to_array(PP, _compute_m_prime(PP))
+    for n, bz, c in zip(idx, BZ, C):
+        res[n] = _verify_v_products(
+            PP, *statements[n], bz[:, :kappa], bz[:, kappa:], c, m_prime
+        )
+    return res
+
+
+def verify_v(PP, proof, commitment, additional_com, public_seed):
+    return verify_v_batch(PP, [(proof, commitment, additional_com)], public_seed)[0]
+
+
 if __name__ == "__main__":
     from commit import commit
     from params import PublicParams
     from public import gen_public_b
+
     from utils import m_from_vote_arr
 
     public_seed = b'-\xc2\xbd\xc1\x12\x94\xac\xd0f\xab~\x9f\x13\xb5\xac\xcaT\xbaFgD\xa6\x93\xd9\x92\xf2"\xb5\x006\x02\xa3'
@@ -330,6 +342,7 @@ if __name__ == "__main__":
         print("There is an error in verification")
 
     print("Trying negative scenarios")
+    statements = [(proof, (t0, t1), additional_com)]
     for v in ([1] * 2 + [0] * (PP.Nc - 2), [2] + [0] * (PP.Nc - 1)):
         m = m_from_vote_arr(PP, v)
         B0, b1 = gen_public_b(PP, public_seed)
@@ -339,3 +352,13 @@ if __name__ == "__main__":
         proof, additional_com = proof_v(PP, t0, t1, r, m, public_seed)
         ver_result = verify_v(PP, proof, (t0, t1), additional_com, public_seed)
         assert ver_result == 1
+        statements.append((proof, (t0, t1), additional_com))
+
+    print("Trying a batch with malformed proofs")
+    proof, commitment, additional_com = statements[0]
+    h, c_hash, Z = proof
+    statements.append(((h, c_hash, Z[:-1]), commitment, additional_com))
+    statements.append(((h, c_hash, [Z[0][:-1]] + Z[1:]), commitment, additional_com))
+    statements.append(statements[0])
+    ver_result = verify_v_batch(PP, statements, public_seed)
+    assert ver_result == [0, 1, 1, 1, 1, 0]
@@ -1,28 +1,174 @@
-from lib.random_polynomials import random_poly
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from types import SimpleNamespace
+
+import numpy as np
+
+from lib.random_polynomials import random_polys_at
+from lib.ring import array_to_poly
 
 
 def gen_public_b(PP, seed):
     B0, b = gen_public_b_with_extra(PP, seed)
-    # gen_public_b_with_extra should call gen_public_b but whatever
     return B0, b[: PP.npoly]
 
 
 def gen_public_b_with_extra(PP, seed):
+    B0_arr, b_arr = gen_public_b_arr(PP, seed)
     B0 = []
-    nonce = 0
     for i in range(PP.kappa):
         row = [0] * PP.baselen
         row[i] = 1
-        for j in range(PP.kappa, PP.baselen):
-            row[j], nonce = random_poly(PP, seed, nonce, PP.d)
+        row[PP.kappa :] = list(array_to_poly(PP, x) for x in B0_arr[i, PP.kappa :])
         B0.append(row)
-        nonce += PP.baselen
     b = []
     for i in range(PP.commit_len):
         bi = [0] * PP.baselen
         bi[i + PP.kappa] = 1
-        for j in range(PP.commit_len + PP.kappa, PP.baselen):
-            bi[j], nonce = random_poly(PP, seed, nonce, PP.d)
+        start = PP.commit_len + PP.kappa
+        bi[start:] = list(array_to_poly(PP, x) for x in b_arr[i, start:])
         b.append(bi)
-        nonce += PP.baselen
     return B0, b
+
+
+# Nonce schedules of the random entries of the public matrices B0
+# (matrix 0) and b (matrix 1), selected by PP.public_b_version.
+# PUBLIC_B_SEQUENTIAL is the original schedule: one nonce per entry, row
+# after row, skipping baselen nonces after every row; it is kept for
+# existing elections. PUBLIC_B_INDEXED derives the nonce of an entry from
+# (matrix, row, column) only. With both schedules every row, and with the
+# indexed one every entry, can be expanded on its own.
+PUBLIC_B_SEQUENTIAL = 0
+PUBLIC_B_INDEXED = 1
+
+
+def _first_random_column(PP, matrix):
+    if matrix == 0:
+        return PP.kappa
+    return PP.kappa + PP.commit_len
+
+
+def public_b_nonces(PP, matrix, row):
+    start = _first_random_column(PP, matrix)
+    if PP.public_b_version == PUBLIC_B_SEQUENTIAL:
+        b0_stride = 2 * PP.baselen - PP.kappa
+        if matrix == 0:
+            first = row * b0_stride
+        else:
+            first = PP.kappa * b0_stride + row * (2 * PP.baselen - start)
+        return range(first, first + PP.baselen - start)
+    assert PP.public_b_version == PUBLIC_B_INDEXED
+    return list(
+        (PUBLIC_B_INDEXED << 56) | (matrix << 48) | (row << 24) | j
+        for j in range(start, PP.baselen)
+    )
+
+
+# row of B0 (matrix 0) or b (matrix 1) as a (baselen, d) array
+def expand_public_row(PP, seed, matrix, row):
+    res = np.zeros((PP.baselen, PP.d), dtype=np.int64)
+    res[row if matrix == 0 else row + PP.kappa, 0] = 1
+    start = _first_random_column(PP, matrix)
+    res[start:] = random_polys_at(PP, seed, public_b_nonces(PP, matrix, row), PP.d)
+    return res
+
+
+def _expand_public_b(PP, seed, processes):
+    rows = list((0, i) for i in range(PP.kappa))
+    rows += list((1, i) for i in range(PP.commit_len))
+    if processes > 1:
+        # PublicParams holds Sage parents, workers only need the sizes
+        params = SimpleNamespace(
+            q=int(PP.q),
+            q_bits=int(PP.q_bits),
+            d=int(PP.d),
+            kappa=int(PP.kappa),
+            baselen=int(PP.baselen),
+            commit_len=int(PP.commit_len),
+            public_b_version=int(PP.public_b_version),
+        )
+        with ProcessPoolExecutor(processes) as pool:
+            res = list(
+                pool.map(_expand_public_row_job, ((params, seed, r) for r in rows))
+            )
+    else:
+        res = list(expand_public_row(PP, seed, *r) for r in rows)
+    return np.stack(res[: PP.kappa]), np.stack(res[PP.kappa :])
+
+
+def _expand_public_row_job(args):
+    params, seed, (matrix, row) = args
+    return expand_public_row(params, seed, matrix, row)
+
+
+# Public matrices B0 (kappa, baselen, d) and b (commit_len, baselen, d),
+# including the extra rows, as read-only arrays (see linear_alg.to_array).
+# They are expanded once per (seed, q, d, kappa, baselen, commit_len,
+# public_b_version), row-parallel with set_public_expand_processes, and
+# kept in memory; with a cache directory (see set_public_cache_dir) they
+# are also stored there as one .npy file, which other processes map
+# instead of expanding the seed again.
+def gen_public_b_arr(PP, seed):
+    key = (bytes(seed),) + tuple(
+        int(v)
+        for v in (
+            PP.q,
+            PP.d,
+            PP.kappa,
+            PP.baselen,
+            PP.commit_len,
+            PP.public_b_version,
+        )
+    )
+    res = _public_b.get(key)
+    if res is None:
+        with _public_b_lock:
+            res = _public_b.get(key)
+            if res is None:
+                res = _load_or_expand(PP, seed, key)
+                _public_b[key] = res
+    return res
+
+
+_public_b = {}
+_public_b_lock = threading.Lock()
+_public_cache_dir = None
+_public_processes = 1
+
+
+def set_public_cache_dir(path):
+    global _public_cache_dir
+    _public_cache_dir = path
+
+
+def set_public_expand_processes(n):
+    global _public_processes
+    _public_processes = n
+
+
+def public_cache_file(key, directory):
+    name = sha256(repr(key).encode()).hexdigest()[:32]
+    return os.path.join(directory, f"public_b_{name}.npy")
+
+
+def _load_or_expand(PP, seed, key):
+    shape = (PP.kappa + PP.commit_len, PP.baselen, PP.d)
+    directory = _public_cache_dir
+    path = None if directory is None else public_cache_file(key, directory)
+    if path is not None and os.path.exists(path):
+        a = np.load(path, mmap_mode="r")
+        if a.shape == shape and a.dtype == np.int64:
+            return a[: PP.kappa], a[PP.kappa :]
+
+    B0, b = _expand_public_b(PP, seed, _public_processes)
+    a = np.concatenate((B0, b))
+    if path is not None:
+        os.makedirs(directory, exist_ok=True)
+        # written under a temporary name so readers never see partial files
+        tmp = f"{path}.{os.getpid()}.tmp"
+        np.save(tmp, a)
+        os.replace(tmp + ".npy", path)
+    a.flags.writeable = False
+    return a[: PP.kappa], a[PP.kappa :]
@@ -1,14 +1,14 @@
+import threading
+
+import numpy as np
 from Crypto.Hash import SHAKE128
 from sage.all import *
-from sage.stats.distributions.discrete_gaussian_integer import \
-    DiscreteGaussianDistributionIntegerSampler
 
 
 def random_zq(PP, seed, nonce, n):
     assert n <= PP.d
-    tmp, nonce = random_poly(PP, seed, nonce, n)
-    tmplist = tmp.list()
-    return list(Integer(tmplist[i]) for i in range(n)), nonce
+    tmp, nonce = random_polys_arr(PP, seed, nonce, 1, n)
+    return list(Integer(v) for v in tmp[0, :n]), nonce
 
 
 def random_poly(PP, seed, nonce, degree):
@@ -16,78 +16,94 @@ def random_poly(PP, seed, nonce, degree):
 
 
 def random_poly_with_zeros(PP, seed, nonce, degree, zeros):
-    shake = SHAKE128.new()
-    shake.update(int(nonce).to_bytes(8, byteorder="big"))
-    shake.update(seed)
-    rnd = shake.read(int(4 * degree))
-    rnd_cnt = 0
-    lst = [0] * degree
-    i = zeros
-    while i < degree:
-        if rnd_cnt < degree:
-            r = int.from_bytes(rnd[rnd_cnt * 4 : (rnd_cnt + 1) * 4], byteorder="big")
-            rnd_cnt += 1
-        else:
-            r = int.from_bytes(shake.read(int(4)), byteorder="big")
-        r = r & ((1 << PP.q_bits) - 1)
-        if r >= PP.q:
-            continue
-        else:
-            lst[i] = r
-            i += 1
-    return PP.P(lst), nonce + 1
+    tmp, nonce = random_polys_arr(PP, seed, nonce, 1, degree, zeros)
+    return PP.P(list(int(v) for v in tmp[0, :degree])), nonce
+
+
+# Coefficients of random_poly_with_zeros(PP, seed, nonce + i, degree, zeros)
+# for i in range(n) as an (n, d) array; returns the array and nonce + n
+def random_polys_arr(PP, seed, nonce, n, degree, zeros=0):
+    return random_polys_at(PP, seed, range(nonce, nonce + n), degree, zeros), nonce + n
+
+
+# The same for arbitrary nonces. Every polynomial has its own XOF stream,
+# which is decoded in blocks of 30-bit words; rejected words are replaced
+# by reading further blocks of the same stream, so the output equals the
+# word-by-word decoding.
+def random_polys_at(PP, seed, nonces, degree, zeros=0):
+    assert degree <= PP.d
+    mask = (1 << PP.q_bits) - 1
+    need = degree - zeros
+    res = np.zeros((len(nonces), PP.d), dtype=np.int64)
+    for i, nonce in enumerate(nonces):
+        shake = SHAKE128.new()
+        shake.update(int(nonce).to_bytes(8, byteorder="big"))
+        shake.update(seed)
+        words = int(degree)
+        r = _EMPTY_WORDS
+        while len(r) < need:
+            w = np.frombuffer(shake.read(4 * words), dtype=">u4").astype(np.int64)
+            w &= mask
+            r = np.concatenate((r, w[w < PP.q]))
+            words = need - len(r)
+        res[i, zeros:degree] = r[:need]
+    return res
+
+
+_EMPTY_WORDS = np.zeros(0, dtype=np.int64)
 
 
 def _chi_map(c):
     return c - (3 & -(c >> 1))
 
 
-def _chi_poly_single(PP, seed, nonce):
-    shake = SHAKE128.new()
-    shake.update(int(nonce).to_bytes(8, byteorder="big"))
-    shake.update(seed)
-    samples_len = PP.d
-    rnd = shake.read(int(samples_len * 4 // 8))
-
-    arr = [0] * (samples_len)
-    a = [0] * 4
-    for i in range(samples_len // 2):
-        r = rnd[i]
+# both coefficients encoded by a byte: every nibble (a0, a1, a2, a3), low
+# bit first, gives (a0 + a1 - a2 - a3) mod 3 mapped to {-1, 0, 1}
+def _chi_table():
+    table = np.zeros((256, 2), dtype=np.int64)
+    for r in range(256):
         for j in range(2):
-            for k in range(4):
-                a[k] = r & 1
-                r >>= 1
-            c = (a[0] + a[1] - a[2] - a[3]) % 3
-            arr[i * 2 + j] = _chi_map(c)
-    return PP.P(arr), nonce + 1
+            a = list((r >> (4 * j + k)) & 1 for k in range(4))
+            table[r, j] = _chi_map((a[0] + a[1] - a[2] - a[3]) % 3)
+    table.flags.writeable = False
+    return table
 
 
-def chi_poly(PP, n, seed, nonce):
-    res = []
+_CHI_TABLE = _chi_table()
+
+
+# chi_poly as an (n, d) array with coefficients mod q
+def chi_poly_arr(PP, n, seed, nonce):
+    res = np.empty((n, PP.d), dtype=np.int64)
     for i in range(n):
-        p, nonce = _chi_poly_single(PP, seed, nonce)
-        res.append(p)
-    return res, nonce
+        shake = SHAKE128.new()
+        shake.update(int(nonce + i).to_bytes(8, byteorder="big"))
+        shake.update(seed)
+        rnd = np.frombuffer(shake.read(int(PP.d // 2)), dtype=np.uint8)
+        res[i] = _CHI_TABLE[rnd].reshape(-1)
+    return res % PP.q, nonce + n
 
 
-def challenge(PP, seed):
+def chi_poly(PP, n, seed, nonce):
+    res, nonce = chi_poly_arr(PP, n, seed, nonce)
+    return list(PP.P(list(int(v) for v in x)) for x in res), nonce
+
+
+# challenges of all seeds as an (n, d) array with coefficients mod q: bits
+# 2i and 2i + 1 of the stream give coefficient a_2i - a_2i+1
+def challenge_arr(PP, seeds):
     d = PP.d
+    rnd = np.empty((len(seeds), d * 2 // 8), dtype=np.uint8)
+    for i, seed in enumerate(seeds):
+        shake = SHAKE128.new()
+        shake.update(seed)
+        rnd[i] = np.frombuffer(shake.read(int(d * 2 // 8)), dtype=np.uint8)
+    bits = np.unpackbits(rnd, axis=1, bitorder="little").astype(np.int64)
+    return (bits[:, 0::2] - bits[:, 1::2]) % PP.q
 
-    shake = SHAKE128.new()
-    shake.update(seed)
-    rnd = shake.read(int(d * 2 // 8))
 
-    arr = [0] * d
-    a = [0] * 2
-    for i in range(d // 4):
-        r = rnd[i]
-        for j in range(4):
-            for k in range(2):
-                a[k] = r & 1
-                r >>= 1
-            c = a[0] - a[1]
-            arr[i * 4 + j] = c
-    return PP.P(arr)
+def challenge(PP, seed):
+    return PP.P(list(int(v) for v in challenge_arr(PP, [seed])[0]))
 
 
 def _uniform_poly_single(PP, seed, nonce):
@@ -128,42 +144,177 @@ def uniform_poly(PP, n, seed, nonce):
     return res, nonce
 
 
-def challenge_amo(PP, seed, p):
+# Word filters of challenge_amo, selected by PP.challenge_amo_version.
+# Entries are drawn from 16-bit big-endian words r <= 257 of the XOF
+# stream: 0 is a zero entry, otherwise (-1)^(r & 1) * X^((r - 1) // 2).
+# CHALLENGE_AMO_COMPAT compares whole words (the original r & 511 had no
+# effect, about 254 words per entry) and reproduces existing challenges;
+# CHALLENGE_AMO_MASKED masks words to 9 bits first (about 2 per entry).
+CHALLENGE_AMO_COMPAT = 0
+CHALLENGE_AMO_MASKED = 1
+
+# words read from the XOF at once once the first block is used up
+CHALLENGE_AMO_CHUNK = 1 << 16
+
+
+# challenge_amo as a (p, amo_n) int16 array: 0 for a zero entry and
+# +-(e + 1) for +-X^e
+def challenge_amo_packed(PP, seed, p):
+    n = p * PP.amo_n
     shake = SHAKE128.new()
     shake.update(seed)
-    # absolutely not effective
-    val_bytes = 2
-    rnd = shake.read(int(val_bytes * 2 * p * PP.amo_n))
-    rnd_offset = 0
+    words = 2 * n
+    vals = []
+    count = 0
+    while count < n:
+        r = np.frombuffer(shake.read(int(2 * words)), dtype=">u2").astype(np.int32)
+        if PP.challenge_amo_version == CHALLENGE_AMO_MASKED:
+            r &= 511
+        else:
+            assert PP.challenge_amo_version == CHALLENGE_AMO_COMPAT
+        r = r[r <= 257]
+        vals.append(r)
+        count += len(r)
+        words = CHALLENGE_AMO_CHUNK
+    r = np.concatenate(vals)[:n].reshape(p, PP.amo_n)
+    packed = np.where(r & 1, -1, 1) * ((r + 1) // 2)
+    return packed.astype(np.int16)
+
+
+def challenge_amo(PP, seed, p):
+    C = challenge_amo_packed(PP, seed, p)
+    return list(
+        list(
+            0 if c == 0 else (1 if c > 0 else -1) * PP.X ** (abs(int(c)) - 1)
+            for c in row
+        )
+        for row in C
+    )
+
+
+# Discrete Gaussian over Z with center 0 and parameter sigma, i.e.
+# P(x) ~ exp(-x^2 / (2 sigma^2)).
+#
+# For sigma <= MAX_TABLE_SIGMA it is cut at |x| <= ceil(tau * sigma) with
+# tau = 6 like Sage's DiscreteGaussianDistributionIntegerSampler(sigma).
+# |x| is drawn by inversion of a cumulative distribution table with
+# 128-bit entries, the sign by a separate random bit, both from the rng
+# passed to sample. Every table entry is within 2^-127 of the exact
+# truncated distribution, so the statistical distance to it is below
+# (B + 1) * 2^-127 per sample for B = ceil(tau * sigma). Sage's sampler
+# computes the same truncated distribution in double or mpfr precision, so
+# both agree up to that sampler's own rounding error.
+#
+# A larger sigma would need a table of 6 sigma entries (and as many big
+# integers while it is built), so x = x1 + k * x2 is returned instead, for
+# independent x1, x2 from the table sampler with sigma0 = sigma / sqrt(1 +
+# k^2) and the smallest k with sigma0 <= MAX_TABLE_SIGMA. By the
+# convolution theorem (Peikert, CRYPTO 2010, Thm. 3.1, with lattices kZ and
+# Z) the sum is within statistical distance 2 eps of D_{Z, sigma} when
+# sigma0 >= eta_eps(Z) and k sigma0 / sqrt(1 + k^2) >= eta_eps(Z), which
+# holds for sigma0 >= sqrt(2) eta_eps(Z). For eps = 2^-100, eta_eps(Z) <=
+# sqrt(ln(2 + 2 / eps) / pi) < 4.8, and sigma0 > MAX_TABLE_SIGMA / 2 is
+# far above that. The cuts of the two base tables add their tail mass,
+# below 2 * 2^-28, so the output is within 2^-26 of the untruncated
+# D_{Z, sigma}, the same order as the tau = 6 cut of the table sampler
+# itself (2^-28).
+class DiscreteGaussianSampler:
+    TAU = 6
+    # fixed-point bits of the weights, well above the 128 bits of the table
+    FRAC_BITS = 192
+    MAX_TABLE_SIGMA = 1 << 14
+
+    def __init__(self, sigma):
+        self.sigma = sigma
+        RF = RealField(256)
+        if RF(sigma) > self.MAX_TABLE_SIGMA:
+            r = RF(sigma) / self.MAX_TABLE_SIGMA
+            self.k = int(ceil((r * r - 1).sqrt()))
+            sigma0 = RF(sigma) / RF(1 + self.k * self.k).sqrt()
+            self.base = DiscreteGaussianSampler(sigma0)
+            self.bound = self.base.bound * (1 + self.k)
+            return
+        self.k = None
+        self.bound = int(ceil(self.TAU * RF(sigma)))
+        cdf = self._cdf()
+        self.cdf_hi = np.array(list(c >> 64 for c in cdf), dtype=np.uint64)
+        self.cdf_lo = np.array(list(c & ((1 << 64) - 1) for c in cdf), dtype=np.uint64)
+
+    # floor(2^128 * P(|x| <= k)) for k < bound
+    def _cdf(self):
+        RF = RealField(self.FRAC_BITS + 64)
+        F = self.FRAC_BITS
+        sigma = RF(self.sigma)
+        # rho(k + 1) = rho(k) * ratio_k, ratio_k = exp(-(2k + 1) / (2 sigma^2))
+        ratio = int(exp(-1 / (2 * sigma**2)) * 2**F)
+        step = int(exp(-1 / sigma**2) * 2**F)
+        rho = 1 << F
+        weights = [rho]
+        for k in range(1, self.bound + 1):
+            rho = rho * ratio >> F
+            ratio = ratio * step >> F
+            weights.append(2 * rho)
+        total = sum(weights)
+        cdf = []
+        acc = 0
+        for w in weights[:-1]:
+            acc += w
+            cdf.append((acc << 128) // total)
+        return cdf
+
+    # integer array of the given shape with randomness from rng
+    def sample(self, shape, rng):
+        if self.k is not None:
+            x1 = self.base.sample(shape, rng)
+            return x1 + self.k * self.base.sample(shape, rng)
+        n = int(np.prod(shape))
+        u = np.frombuffer(rng.randombytes(16 * n), dtype=">u8").reshape(n, 2)
+        hi = u[:, 0].astype(np.uint64)
+        lo = u[:, 1].astype(np.uint64)
+        a = np.searchsorted(self.cdf_hi, hi, side="left")
+        b = np.searchsorted(self.cdf_hi, hi, side="right")
+        x = a.astype(np.int64)
+        # equal high words, resolved by the low words
+        for i in np.flatnonzero(b > a):
+            x[i] += np.searchsorted(self.cdf_lo[a[i] : b[i]], lo[i], side="right")
+        signs = np.unpackbits(
+            np.frombuffer(rng.randombytes((n + 7) // 8), dtype=np.uint8)
+        )
+        x = np.where(signs[:n] == 1, -x, x)
+        return x.reshape(shape)
+
+
+def get_gaussian_sampler(sigma):
+    key = float(sigma)
+    sampler = _gaussian_samplers.get(key)
+    if sampler is None:
+        with _gaussian_samplers_lock:
+            sampler = _gaussian_samplers.get(key)
+            if sampler is None:
+                sampler = DiscreteGaussianSampler(sigma)
+                _gaussian_samplers[key] = sampler
+    return sampler
+
+
+_gaussian_samplers = {}
+_gaussian_samplers_lock = threading.Lock()
+
+
+# n polynomials as an (n, d) array with coefficients mod q
+def discrete_gaussian_vector_y_arr(PP, n, sigma):
+    return get_gaussian_sampler(sigma).sample((n, PP.d), PP.rng) % PP.q
+
 
-    c = []
-    for i in range(p):
-        row = [0] * PP.amo_n
-        for j in range(PP.amo_n):
-            while True:
-                if rnd_offset < len(rnd):
-                    r = int.from_bytes(
-                        rnd[rnd_offset : rnd_offset + val_bytes], byteorder="big"
-                    )
-                    rnd_offset += val_bytes
-                else:
-                    r = int.from_bytes(shake.read(int(val_bytes)), byteorder="big")
-                r & 511
-                if r <= 257:
-                    if r == 0:
-                        row[j] = 0
-                    else:
-                        row[j] = (-1) ** (r & 1) * PP.X ** ((r - 1) // 2)
-                    break
-        c.append(row)
-    return c
+# m x n matrix as an (m, n, d) array with coefficients mod q
+def discrete_gaussian_y_arr(PP, m, n, sigma):
+    return get_gaussian_sampler(sigma).sample((m, n, PP.d), PP.rng) % PP.q
 
 
 def discrete_gaussian_vector_y(PP, n, sigma):
-    D = DiscreteGaussianDistributionIntegerSampler(sigma=sigma)
-    return list(PP.R(list(D() for _ in range(PP.d))) for j in range(n))
+    Y = discrete_gaussian_vector_y_arr(PP, n, sigma)
+    return list(PP.R(list(int(v) for v in y)) for y in Y)
 
 
 def discrete_gaussian_y(PP, m, n, sigma):
-    D = DiscreteGaussianDistributionIntegerSampler(sigma=sigma)
-    return Matrix(PP.R, m, n, lambda i, j: PP.R(list(D() for _ in range(PP.d))))
+    Y = discrete_gaussian_y_arr(PP, m, n, sigma)
+    return Matrix(PP.R, m, n, lambda i, j: PP.R(list(int(v) for v in Y[i, j])))
@@ -1,3 +1,6 @@
+import threading
+
+import numpy as np
 from sage.all import *
 
 
@@ -14,32 +17,168 @@ def powers_of_zeta(zeta, l, k):
     return powers
 
 
+def mod_matmul(a, b, q):
+    # a, b are reduced mod q < 2^30; split a into 15-bit limbs so that
+    # int64 accumulators cannot overflow for inner dimensions below 2^17
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    hi = np.matmul(a >> 15, b) % q
+    lo = np.matmul(a & 0x7FFF, b) % q
+    return ((hi << 15) + lo) % q
+
+
+# Precomputed tables of Z_q[X]/(X^d + 1) split into l factors
+# X^(d/l) - zeta^p. Layer by layer every factor X^(2m) - zeta^e is split
+# into X^m - zeta^(e/2) and X^m - zeta^(e/2 + l) (Cooley-Tukey butterflies),
+# so the ring may be only partially split. Residues are kept in the order
+# of `powers`. Contexts are shared between PublicParams with the same ring
+# and are never modified after construction.
+class RingContext:
+    def __init__(self, q, d, l, k, zeta):
+        self.q = q
+        self.d = d
+        self.l = l
+        self.k = k
+        self.s = d // l
+        self.layers = l.bit_length() - 1
+        assert 1 << self.layers == l
+        self.powers = tuple(powers_of_zeta(zeta, l, k))
+
+        exps = [l]
+        tw = []
+        inv_tw = []
+        for layer in range(self.layers):
+            w = list(pow(zeta, e // 2, q) for e in exps)
+            tw.append(_frozen(np.array(w).reshape(-1, 1)))
+            inv_tw.append(
+                _frozen(np.array(list(pow(x, -1, q) for x in w)).reshape(-1, 1))
+            )
+            exps = list(x for e in exps for x in (e // 2, e // 2 + l))
+        self.tw = tuple(tw)
+        self.inv_tw = tuple(inv_tw)
+
+        # tree order -> `powers` order
+        self.perm = _frozen(np.array(list(exps.index(p) for p in self.powers)))
+        self.inv_perm = _frozen(np.argsort(self.perm))
+        # moduli[i] = zeta^p, the i-th factor is X^(d/l) - moduli[i]
+        self.moduli = _frozen(np.array(list(pow(zeta, p, q) for p in self.powers)))
+        self.l_inv = pow(l, -1, q)
+
+        # crt_basis[i] = 1 mod the i-th factor and 0 mod all the others
+        units = np.zeros((l, d), dtype=np.int64)
+        units[np.arange(l), np.arange(l) * self.s] = 1
+        self.crt_basis = _frozen(intt(self, units))
+
+
+def _frozen(a):
+    a = np.asarray(a, dtype=np.int64)
+    a.flags.writeable = False
+    return a
+
+
+def ntt(ctx, a):
+    q = ctx.q
+    a = np.asarray(a, dtype=np.int64) % q
+    shape = a.shape
+    a = a.reshape(shape[:-1] + (1, ctx.d))
+    for w in ctx.tw:
+        half = a.shape[-1] // 2
+        t = a[..., half:] * w % q
+        lo = a[..., :half]
+        a = np.stack(((lo + t) % q, (lo - t) % q), axis=-2)
+        a = a.reshape(a.shape[:-3] + (-1, half))
+    return a[..., ctx.perm, :].reshape(shape)
+
+
+def intt(ctx, a):
+    q = ctx.q
+    a = np.asarray(a, dtype=np.int64) % q
+    shape = a.shape
+    a = a.reshape(shape[:-1] + (ctx.l, ctx.s))[..., ctx.inv_perm, :]
+    for w in reversed(ctx.inv_tw):
+        r = a.reshape(a.shape[:-2] + (-1, 2, a.shape[-1]))
+        r1, r2 = r[..., 0, :], r[..., 1, :]
+        a = np.concatenate(((r1 + r2) % q, (r1 - r2) % q * w % q), axis=-1)
+    return (a.reshape(shape) * ctx.l_inv) % q
+
+
+# product of two arrays in NTT form: pointwise for a fully split ring,
+# otherwise multiplication of residues modulo X^(d/l) - zeta^p
+def ntt_mul(ctx, a, b):
+    q, s = ctx.q, ctx.s
+    if s == 1:
+        return a * b % q
+    a = a.reshape(a.shape[:-1] + (ctx.l, s))
+    b = b.reshape(b.shape[:-1] + (ctx.l, s))
+    shape = np.broadcast_shapes(a.shape, b.shape)
+    c = np.zeros(shape[:-1] + (2 * s - 1,), dtype=np.int64)
+    for i in range(s):
+        c[..., i : i + s] = (c[..., i : i + s] + a[..., i : i + 1] * b % q) % q
+    hi = c[..., s:] * ctx.moduli.reshape(-1, 1) % q
+    c = c[..., :s]
+    c[..., : s - 1] = (c[..., : s - 1] + hi) % q
+    return c.reshape(shape[:-2] + (ctx.d,))
+
+
+def get_ring_context(q, d, l, k, zeta):
+    key = (q, d, l, k, zeta)
+    ctx = _contexts.get(key)
+    if ctx is None:
+        with _contexts_lock:
+            ctx = _contexts.get(key)
+            if ctx is None:
+                ctx = RingContext(q, d, l, k, zeta)
+                _contexts[key] = ctx
+    return ctx
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def poly_to_array(PP, x):
+    if parent(x) is PP.R:
+        x = x.lift()
+    c = np.array(list(int(v) for v in PP.P(x).list()), dtype=np.int64)
+    n = -(-len(c) // PP.d) * PP.d
+    c = np.concatenate((c, np.zeros(max(n, PP.d) - len(c), dtype=np.int64)))
+    # X^d = -1
+    c = c.reshape(-1, PP.d)
+    signs = np.where(np.arange(len(c)) % 2 == 0, 1, -1).reshape(-1, 1)
+    return (c * signs).sum(axis=0) % PP.q
+
+
+def array_to_poly(PP, a):
+    return PP.P(list(int(v) for v in a))
+
+
+def _residue_to_array(PP, x, w):
+    s = PP.d // PP.l
+    res = [0] * s
+    wi = 1
+    for i, c in enumerate(PP.P(x).list()):
+        if i and i % s == 0:
+            wi = wi * w % PP.q
+        res[i % s] = (res[i % s] + int(c) * wi) % PP.q
+    return res
+
+
 def NTT(PP, x):
-    global powers
-    if powers is None:
-        powers = powers_of_zeta(PP.zeta, PP.l, PP.k)
-    return list(x.mod(PP.X ** (PP.d // PP.l) - PP.zeta**p) for p in powers)
+    ctx = PP.ring_ctx
+    r = ntt(ctx, poly_to_array(PP, x))
+    return list(array_to_poly(PP, r[i * ctx.s : (i + 1) * ctx.s]) for i in range(ctx.l))
 
 
 def INTT(PP, r):
-    global powers
-    if powers is None:
-        powers = powers_of_zeta(PP.zeta, PP.l, PP.k)
-    m = list(PP.X ** (PP.d // PP.l) - PP.zeta**p for p in powers)
-    P, X = PP.P, PP.X
-    M = 1
-    for poly in m:
-        M *= poly
-    res = 0
-    for i in range(len(r)):
-        Mi = M / m[i]
-        R, x = P.quotient(m[i]).objgen()
-
-        xi = r[i] * Mi * P((1 / R(Mi)).list())
-        xi = P(xi)
-        # xi = P(r[i].list()) * Mi * P((1/R(Mi)).list())
-        res += xi
-    return P(res).mod(X**PP.d + 1)
+    ctx = PP.ring_ctx
+    a = np.array(
+        list(_residue_to_array(PP, r[i], int(ctx.moduli[i])) for i in range(ctx.l)),
+        dtype=np.int64,
+    )
+    if not a[:, 1:].any():
+        # constant residues: weighted sum of the CRT basis
+        return array_to_poly(PP, mod_matmul(a[:, 0], ctx.crt_basis, ctx.q))
+    return array_to_poly(PP, intt(ctx, a.reshape(-1)))
 
 
 def signed_zq(v, q):
@@ -49,14 +188,6 @@ def signed_zq(v, q):
     return v
 
 
-def reset_powers():
-    global powers
-    powers = None
-
-
-powers = None
-
-
 if __name__ == "__main__":
     from params import PublicParams
 
@@ -65,11 +196,16 @@ if __name__ == "__main__":
     f = R.random_element()
     f = PP.P(f.list())
     assert INTT(PP, NTT(PP, f)) == f
+    assert NTT(PP, f) == list(
+        f.mod(PP.X ** (PP.d // PP.l) - PP.zeta**p) for p in PP.ring_ctx.powers
+    )
 
-    # Update powers for different params
-    powers = None
+    # Parameters with a different ring get their own context
     PP = PublicParams(2, 127, 10)
     R = PP.R
     f = R.random_element()
     f = PP.P(f.list())
     assert INTT(PP, NTT(PP, f)) == f
+    assert NTT(PP, f) == list(
+        f.mod(PP.X ** (PP.d // PP.l) - PP.zeta**p) for p in PP.ring_ctx.powers
+    )
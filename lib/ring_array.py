@@ -0,0 +1,111 @@
+import numpy as np
+
+from lib.linear_alg import from_array, to_array
+from lib.ring import intt, ntt
+
+
+# Array (..., d) of ring elements kept in coefficient form, in NTT form or
+# both. Each form is computed on first use and cached, so sums stay in
+# whatever form the operands already have and products never transform the
+# same data twice. Coefficients are only needed at the boundaries: hashing,
+# serialization and decoding. Instances are never modified in place.
+class RingArray:
+    def __init__(self, PP, coeffs=None, evals=None):
+        assert coeffs is not None or evals is not None
+        self.PP = PP
+        self._coeffs = coeffs
+        self._evals = evals
+
+    @classmethod
+    def from_polys(cls, PP, x):
+        if isinstance(x, RingArray):
+            return x
+        return cls(PP, coeffs=to_array(PP, x))
+
+    @property
+    def coeffs(self):
+        if self._coeffs is None:
+            self._coeffs = intt(self.PP.ring_ctx, self._evals)
+        return self._coeffs
+
+    @property
+    def evals(self):
+        if self._evals is None:
+            self._evals = ntt(self.PP.ring_ctx, self._coeffs)
+        return self._evals
+
+    @property
+    def shape(self):
+        a = self._coeffs if self._coeffs is not None else self._evals
+        return a.shape[:-1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _map(self, f):
+        return RingArray(
+            self.PP,
+            None if self._coeffs is None else f(self._coeffs),
+            None if self._evals is None else f(self._evals),
+        )
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        return self._map(lambda a: a[idx + (Ellipsis, slice(None))])
+
+    def swapaxes(self, a1, a2):
+        return self._map(lambda a: np.swapaxes(a, a1, a2))
+
+    def sum(self, axis=0):
+        q = self.PP.q
+        return self._map(lambda a: a.sum(axis=axis) % q)
+
+    # sums of consecutive blocks of `size` entries along the first axis,
+    # the last block may be shorter
+    def block_sums(self, size):
+        q = self.PP.q
+        idx = np.arange(0, len(self), size)
+        return self._map(lambda a: np.add.reduceat(a, idx, axis=0) % q)
+
+    # NTT form is used as soon as one of the operands has it
+    def _binop(self, other, f):
+        other = RingArray.from_polys(self.PP, other)
+        q = self.PP.q
+        if self._evals is not None or other._evals is not None:
+            return RingArray(self.PP, evals=f(self.evals, other.evals) % q)
+        return RingArray(self.PP, coeffs=f(self._coeffs, other._coeffs) % q)
+
+    def __add__(self, other):
+        return self._binop(other, np.add)
+
+    def __sub__(self, other):
+        return self._binop(other, np.subtract)
+
+    def __neg__(self):
+        q = self.PP.q
+        return self._map(lambda a: (q - a) % q)
+
+    def to_polys(self, ring=None):
+        return from_array(self.PP, self.coeffs, ring)
+
+
+def concatenate(PP, arrays, axis=0):
+    arrays = list(RingArray.from_polys(PP, a) for a in arrays)
+    if all(a._evals is not None for a in arrays):
+        return RingArray(PP, evals=np.concatenate(list(a.evals for a in arrays), axis))
+    return RingArray(PP, coeffs=np.concatenate(list(a.coeffs for a in arrays), axis))
+
+
+# NTT form of x given as a RingArray, a coefficient array or Sage polynomials
+def evals(PP, x):
+    if isinstance(x, RingArray):
+        return x.evals
+    return ntt(PP.ring_ctx, to_array(PP, x))
+
+
+# coefficient form of x given as a RingArray, an array or Sage polynomials
+def coeffs(PP, x):
+    if isinstance(x, RingArray):
+        return x.coeffs
+    return to_array(PP, x)
@@ -1,42 +1,133 @@
+import math
+import threading
 from os import urandom
 
+import numpy as np
+from Crypto.Hash import SHAKE128
 from sage.all import *
-from sage.misc.prandom import random as random_prob
 
-from lib.linear_alg import (l2_norm_matr, l2_norm_vect, scalar_matrix_zz,
-                            scalar_vector_zz)
-from lib.ring import INTT, reset_powers
+from lib.linear_alg import centered, exact_sum
+from lib.ring import INTT
 
 
 def poly_to_bytes(p):
-    return b"".join(int(x).to_bytes(4, byteorder="big") for x in p.list())
+    return array_to_bytes(_polys_to_coefficients([p]))
+
+
+# coefficients of all polynomials of an array (..., d) as big-endian uint32,
+# the same bytes as poly_to_bytes of the corresponding elements of PP.R
+def array_to_bytes(a):
+    return np.ascontiguousarray(a, dtype=">u4").tobytes()
+
+
+# p.list() of all polynomials, one after another
+def _polys_to_coefficients(polys):
+    return np.array(list(int(x) for p in polys for x in p.list()), dtype=np.int64)
+
+
+# Fiat-Shamir transcript over SHAKE128. Polynomials are absorbed as the
+# big-endian uint32 words of poly_to_bytes and arrays like array_to_bytes:
+# the coefficients of a whole array are converted in one pass and the
+# buffer is absorbed through a memoryview, without a bytes object per
+# polynomial or coefficient. The hashes are the same as absorbing
+# poly_to_bytes of every polynomial one by one.
+class Transcript:
+    def __init__(self):
+        self._shake = SHAKE128.new()
+
+    def absorb(self, data):
+        self._shake.update(data)
+
+    def absorb_array(self, a):
+        a = np.ascontiguousarray(a, dtype=">u4")
+        self._shake.update(memoryview(a).cast("B"))
+
+    def absorb_polys(self, polys):
+        self.absorb_array(_polys_to_coefficients(polys))
+
+    def read(self, n):
+        return self._shake.read(int(n))
 
 
 def randombytes(l):
     return urandom(l)
 
 
-def _rejection_sampling(scalar, norm, sigma, M):
-    u = random_prob()
-    border = 1 / M * e ** ((-2 * scalar + norm) / (2 * sigma**2))
-    if u > border:
-        return 0
-    else:
-        return 1
+# Randomness providers, PP.rng. Every random choice of the scheme (seeds,
+# masks, rejection decisions) is drawn from PP.rng, so a run is determined
+# by the provider. SystemRandomness is the CSPRNG of the OS.
+class SystemRandomness:
+    def randombytes(self, l):
+        return urandom(l)
+
+    # uniform in [0, 1) with 53 random bits
+    def random(self):
+        return _bytes_to_unit(self.randombytes(7))
+
+
+# Deterministic provider for reproducible benchmarks and profiling: the
+# output stream of SHAKE128(seed). Runs with the same seed and the same
+# sequence of calls draw the same values, attempt for attempt. Never use it
+# for real elections. Draws are serialized by a lock; with concurrent
+# consumers (e.g. precompute.ProverPool) the order is not reproducible.
+class DeterministicRandomness:
+    def __init__(self, seed):
+        self._shake = SHAKE128.new()
+        self._shake.update(b"kmzi deterministic rng")
+        self._shake.update(seed)
+        self._lock = threading.Lock()
+
+    def randombytes(self, l):
+        with self._lock:
+            return self._shake.read(int(l))
+
+    def random(self):
+        return _bytes_to_unit(self.randombytes(7))
+
+
+def _bytes_to_unit(b):
+    return (int.from_bytes(b, byteorder="big") >> 3) / float(1 << 53)
+
+
+# Accepts with probability min(1, exp((||B||^2 - 2<Z, B>) / (2 sigma^2)) / M).
+# The decision is taken in double precision against constants computed once
+# per (sigma, M); when log(u) is too close to the border to be decided in
+# double precision it is redone with 200-bit reals, so every u gets the
+# same answer as the exact comparison.
+class RejectionSampler:
+    def __init__(self, sigma, M):
+        self.sigma = sigma
+        self.M = M
+        self.inv_two_sigma_sq = float(1 / (2 * sigma**2))
+        self.log_M = float(log(M))
+
+    def accept(self, exponent, rng):
+        u = rng.random()
+        if u == 0:
+            return 1
+        log_border = float(exponent) * self.inv_two_sigma_sq - self.log_M
+        log_u = math.log(u)
+        if abs(log_u - log_border) > 1e-9 * max(1, abs(log_border)):
+            return 1 if log_u <= log_border else 0
+        RF = RealField(200)
+        border = exp(RF(exponent) / (2 * RF(self.sigma) ** 2)) / RF(self.M)
+        return 1 if RF(u) <= border else 0
+
+
+# ||B||^2 - 2<Z, B> over centered coefficients in one pass
+def _rejection_exponent(Z, B, q):
+    B = centered(B, q)
+    return exact_sum(B * (B - 2 * centered(Z, q)))
 
 
 # returns 1, if Z is independent from B
-def rejection_sampling_matrix(Z, B, sigma, M, q):
-    scalar = scalar_matrix_zz(Z, B, q)
-    norm = l2_norm_matr(B, q) ** 2
-    return _rejection_sampling(scalar, norm, sigma, M)
+def rejection_sampling_matrix(Z, B, sampler, q, rng):
+    return sampler.accept(_rejection_exponent(Z, B, q), rng)
 
 
 # returns 1, if z is independent from cr
-def rejection_sampling_vector(z, cr, sigma, M, q):
-    scalar = scalar_vector_zz(z, cr, q)
-    norm = l2_norm_vect(cr, q) ** 2
-    return _rejection_sampling(scalar, norm, sigma, M)
+def rejection_sampling_vector(z, cr, sampler, q, rng):
+    return sampler.accept(_rejection_exponent(z, cr, q), rng)
 
 
 def max_with_index(l):
@@ -57,9 +148,3 @@ def m_from_vote_arr(PP, vote_arr):
     v = vote_arr + [0] * (vlen - PP.Nc)
 
     return list(INTT(PP, v[i * PP.l : (i + 1) * PP.l]) for i in range(PP.npoly))
-
-
-# We need to reset variables when changing public parameters
-# variable `powers` is computed only once in order to speed up NTT/INTT
-def reset_all():
-    reset_powers()
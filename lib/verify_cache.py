@@ -0,0 +1,92 @@
+import os
+import threading
+from hashlib import sha256
+
+from lib.utils import poly_to_bytes
+
+# Verdicts of ballot checks by content. The key is a digest of the public
+# seed, the parameters and everything the check reads, so a ballot that is
+# checked again (by another authority, by verify or by a later run) is a
+# lookup. Both verdicts are kept in memory; with a cache file (see
+# set_verify_cache_file) they are also appended to it as "<digest> <verdict>"
+# lines, which later runs and other processes read back.
+
+_verdicts = {}
+_verdicts_lock = threading.Lock()
+_verify_cache_file = None
+
+
+def set_verify_cache_file(path):
+    global _verify_cache_file
+    with _verdicts_lock:
+        _verify_cache_file = path
+        if path is None or not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                # the last line may be cut if a writer was interrupted
+                if len(parts) == 2 and parts[1] in ("0", "1"):
+                    _verdicts[parts[0]] = int(parts[1])
+
+
+def clear_verify_cache():
+    with _verdicts_lock:
+        _verdicts.clear()
+
+
+def ballot_digest(PP, public_seed, ballot):
+    h = sha256()
+    params = (bytes(public_seed),) + tuple(
+        int(v)
+        for v in (
+            PP.q,
+            PP.d,
+            PP.l,
+            PP.k,
+            PP.Na,
+            PP.Nc,
+            PP.kappa,
+            PP.baselen,
+            PP.commit_len,
+            PP.g_zeros,
+            PP.l2_bound1_sq,
+            PP.public_b_version,
+        )
+    )
+    h.update(repr(params).encode())
+    _update(h, (ballot.vproof, ballot.com, ballot.additional_com))
+    return h.hexdigest()
+
+
+# nested tuples and lists of polynomials and bytes, every item prefixed by
+# its length so that different contents never give the same stream
+def _update(h, x):
+    if isinstance(x, (tuple, list)):
+        h.update(b"l" + len(x).to_bytes(4, byteorder="big"))
+        for v in x:
+            _update(h, v)
+        return
+    if isinstance(x, bytes):
+        b = b"b" + x
+    else:
+        b = b"p" + poly_to_bytes(x)
+    h.update(len(b).to_bytes(4, byteorder="big") + b)
+
+
+# verdict of every digest, None if it is not known
+def cached_verdicts(digests):
+    with _verdicts_lock:
+        return list(_verdicts.get(x) for x in digests)
+
+
+def store_verdicts(pairs):
+    lines = []
+    with _verdicts_lock:
+        for digest, verdict in pairs:
+            if _verdicts.get(digest) != verdict:
+                _verdicts[digest] = verdict
+                lines.append(f"{digest} {verdict}\n")
+        if lines and _verify_cache_file is not None:
+            with open(_verify_cache_file, "a") as f:
+                f.write("".join(lines))
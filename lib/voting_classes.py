@@ -50,6 +50,20 @@ class Ballot:
         self.signature = signature
 
 
+# Vote-independent material of a ballot, see voting_scheme.prepare_ballot
+class PreparedBallot:
+    def __init__(self, PP, public_seed, shares, S, r, T0, bS, vproof_material):
+        self.PP = PP
+        self.public_seed = public_seed
+        self.shares = shares
+        self.S = S
+        self.r = r
+        self.T0 = T0
+        self.bS = bS
+        self.vproof_material = vproof_material
+        self.used = False
+
+
 class Tally:
     def __init__(self, a_id, amo_proof, amo_zero_proof, T, r, signature):
         self.a_id = a_id
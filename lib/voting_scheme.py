@@ -1,26 +1,46 @@
-from lib.commit import commit, commit_with_r
-from lib.linear_alg import inf_norm_vect, matrix_vector, scalar
+import numpy as np
+
+from lib.commit import commit_batch
+from lib.linear_alg import (from_array, inf_norm_vect, matrix_vector_ntt,
+                            to_array)
+from lib.params import shutdown_worker_pool, worker_params, worker_pool
 from lib.proof_sum import sum_of_commitments, verify_sum_of_commitments
-from lib.proof_v import proof_v, verify_v
-from lib.public import gen_public_b
-from lib.random_polynomials import random_poly
-from lib.ring import INTT, NTT
-from lib.utils import m_from_vote_arr, randombytes
-from lib.voting_classes import Ballot, Tally
+from lib.proof_v import prepare_proof_v, proof_v, verify_v_batch
+from lib.public import gen_public_b_arr
+from lib.random_polynomials import chi_poly_arr, random_poly
+from lib.ring import array_to_poly
+from lib.ring_array import RingArray
+from lib.utils import m_from_vote_arr
+from lib.verify_cache import ballot_digest, cached_verdicts, store_verdicts
+from lib.voting_classes import Ballot, PreparedBallot, Tally
+
+
+# random shares x_0, ..., x_(n-2) of each of the npoly polynomials
+def _random_shares(PP, n, seed, nonce):
+    res = []
+    for j in range(PP.npoly):
+        x = [0] * (n - 1)
+        for i in range(n - 1):
+            x[i], nonce = random_poly(PP, seed, nonce, PP.d)
+        res.append(x)
+    return res, nonce
 
 
-def _secret_share_value(PP, val, n, seed, nonce):
+# shares of val whose first n - 1 shares are the given random ones
+def _complete_shares(PP, val, n, shares):
     res = []
     for i in range(n):
         res.append([0] * PP.npoly)
     for j in range(PP.npoly):
-        x = [0] * n
-        for i in range(n - 1):
-            x[i], nonce = random_poly(PP, seed, nonce, PP.d)
-        x[n - 1] = val[j] - sum(x[i] for i in range(n - 1))
+        x = shares[j] + [val[j] - sum(shares[j])]
         for i in range(n):
             res[i][j] = x[i]
-    return res, nonce
+    return res
+
+
+def _secret_share_value(PP, val, n, seed, nonce):
+    shares, nonce = _random_shares(PP, n, seed, nonce)
+    return _complete_shares(PP, val, n, shares), nonce
 
 
 """
@@ -34,43 +54,90 @@ Parameters:
 
 
 def vote(PP, v_id, vote_arr, public_seed, BB):
-    seed = randombytes(PP.seedlen)
-    r_seed = randombytes(PP.seedlen)
-    nonce = 0
+    ballot = finish_ballot(prepare_ballot(PP, public_seed), vote_arr, v_id)
+    BB.add_ballot(ballot)
 
-    B0, b = gen_public_b(PP, public_seed)
 
-    # m is a correct vote
-    m = m_from_vote_arr(PP, vote_arr)
+"""
+Offline phase of vote: everything that does not depend on the vote.
+Parameters:
+    PP - public parameters
+    public_seed - public trusted parameter
+    masks - number of VProof masks prepared, further masks are drawn
+            online if all of them are rejected
+"""
 
-    # x is divided m between authorities
-    x, _ = _secret_share_value(PP, m, PP.Na, seed, 0)
+
+def prepare_ballot(PP, public_seed, masks=2):
+    seed = PP.rng.randombytes(PP.seedlen)
+    r_seed = PP.rng.randombytes(PP.seedlen)
+    nonce = 0
+
+    B0, b = gen_public_b_arr(PP, public_seed)
+
+    # random parts of the shares of the vote
+    shares, _ = _random_shares(PP, PP.Na, seed, 0)
 
     # sending parts of vote to corresponding authorities
-    S = []
-    T0 = []
-    T1 = []
-    for i in range(PP.Na):
-        t0, t1, r, nonce = commit(PP, B0, b, x[i], r_seed, nonce)
-        S.append(r)
-        T0.append(t0)
-        T1.append(t1)
+    S, nonce = chi_poly_arr(PP, PP.Na * PP.baselen, r_seed, nonce)
+    S = S.reshape(PP.Na, PP.baselen, PP.d)
 
     # creating r - number of secret vectors
-    r = list(sum(S[j][i] for j in range(PP.Na)) for i in range(PP.baselen))
+    r = S.sum(axis=0) % PP.q
+
+    # B0 * s and b * s of the Na commitments for the shares and of the
+    # commitment for the vote, messages are added in finish_ballot
+    zero = np.zeros((PP.Na + 1, PP.npoly, PP.d), dtype=np.int64)
+    T0, bS = commit_batch(PP, B0, b, zero, np.concatenate((S, r[None])), ntt_form=True)
+    return PreparedBallot(
+        PP,
+        public_seed,
+        shares,
+        S,
+        r,
+        T0.to_polys(),
+        bS.coeffs,
+        prepare_proof_v(PP, r, public_seed, masks),
+    )
 
-    # creating Na commitments for x[i] using secret vectors r
-    t0, t1 = commit_with_r(PP, B0, b, m, r)
+
+"""
+Online phase of vote.
+Parameters:
+    prepared - result of prepare_ballot, can be used once
+    vote_arr - ballot with candidates
+    v_id - voter id
+"""
+
+
+def finish_ballot(prepared, vote_arr, v_id=None):
+    assert not prepared.used
+    prepared.used = True
+    PP = prepared.PP
+
+    # m is a correct vote
+    m = m_from_vote_arr(PP, vote_arr)
+
+    # x is divided m between authorities
+    x = _complete_shares(PP, m, PP.Na, prepared.shares)
+
+    # Na commitments for x[i] and the commitment for m
+    T0 = list(prepared.T0)
+    T1 = from_array(PP, (prepared.bS + to_array(PP, x + [m])) % PP.q)
+    t0, t1 = T0.pop(), T1.pop()
 
     # VProof is used to show that this vote m is correct
-    vproof, additional_com = proof_v(PP, t0, t1, r, m, public_seed)
+    vproof, additional_com = proof_v(
+        PP, t0, t1, prepared.r, m, prepared.public_seed, prepared.vproof_material
+    )
 
     # ballots should be signed while transfered to bulletin board
     signature = None
 
-    # transfer committed vote to bulletin board. S should be encrypted in real systems
-    ballot = Ballot(v_id, vproof, (T0, T1), additional_com, S, signature)
-    BB.add_ballot(ballot)
+    # S should be encrypted in real systems
+    return Ballot(
+        v_id, vproof, (T0, T1), additional_com, from_array(PP, prepared.S), signature
+    )
 
 
 """
@@ -84,16 +151,15 @@ Parameters:
 
 def testballots(PP, a_id, public_seed, BB):
     ballot_correctness = {}
-    for v_id, ballot in BB.all_ballots():
-        ok = 0
+    ballots = list(BB.all_ballots())
+    # Check that votes in commitments are correct using zero-knowledge VProof
+    vproof_res = _check_ballot_vproofs(PP, (b for _, b in ballots), public_seed)
+    for (v_id, ballot), ok in zip(ballots, vproof_res):
         # decrypt vectors, encrypted by voters, using authority's secret key (not implemented)
         r = ballot.enc_r[a_id]
 
-        # Check that votes in commitments are correct using zero-knowledge VProof
         if inf_norm_vect(r, PP.q) > PP.beta_commit_infty:
             ok = 1
-        if _check_ballot_vproof(PP, ballot, public_seed):
-            ok = 1
         ballot_correctness[v_id] = ok
         if ok == 1:
             print(f"voter {v_id} is cheating! - says authority {a_id}")
@@ -108,7 +174,9 @@ def _extract_from_ballot_by_j(PP, v_id, a_id, ballot):
     return r, T0[a_id], T1[a_id]
 
 
-def tally_j(PP, a_id, public_seed, BB):
+# pool is an optional precompute.ProverPool filled while the authority
+# waits for the end of the voting; stats as in proof_sum.sum_of_commitments
+def tally_j(PP, a_id, public_seed, BB, pool=None, stats=None):
     S = []
     T0 = []
     T1 = []
@@ -117,73 +185,142 @@ def tally_j(PP, a_id, public_seed, BB):
         S.append(r)
         T0.append(t0)
         T1.append(t1)
-    amo_proof, amo_zero_proof, T, r = sum_of_commitments(PP, S, T0, T1, public_seed)
+    amo_proof, amo_zero_proof, T, r = sum_of_commitments(
+        PP, S, T0, T1, public_seed, pool, stats
+    )
     # We should sign tallies
     signature = None
     BB.add_authority_tally(Tally(a_id, amo_proof, amo_zero_proof, T, r, signature))
 
 
+# zero and x are RingArrays in NTT form
 def _extract_authority_result(PP, B0, b, tally):
-    r = tally.final_com_r
+    r = RingArray.from_polys(PP, tally.final_com_r).evals
     T0, T1 = tally.additional_com
-    t0 = T0[-1]
-    t1 = T1[-1]
-    B0r = matrix_vector(B0, r, PP.X, PP.d)
-    zero = list(t0[i] - B0r[i] for i in range(PP.kappa))
-    x = list((t1[i] - scalar(b[i], r, PP.X, PP.d)) for i in range(PP.npoly))
+    t0 = RingArray.from_polys(PP, T0[-1])
+    t1 = RingArray.from_polys(PP, T1[-1])
+    zero = t0 - RingArray(PP, evals=matrix_vector_ntt(PP, B0.evals, r))
+    x = t1 - RingArray(PP, evals=matrix_vector_ntt(PP, b.evals, r))
     return zero, x
 
 
 def _check_zero(PP, zero):
-    for i in range(PP.kappa):
-        if zero[i] != 0:
-            return 1
+    if zero.evals.any():
+        return 1
     return 0
 
 
+# res is the sum of all x in NTT form, its residues are the counts of votes
 def _res_to_list_of_candidates(PP, res):
-    l = list(val for x in res for val in NTT(PP, x))
+    s = PP.d // PP.l
+    l = list(
+        array_to_poly(PP, x[i * s : (i + 1) * s])
+        for x in res.evals
+        for i in range(PP.l)
+    )
     return l[: PP.Nc]
 
 
+def _public_b_ntt(PP, public_seed):
+    B0, b = gen_public_b_arr(PP, public_seed)
+    return RingArray(PP, coeffs=B0), RingArray(PP, coeffs=b[: PP.npoly])
+
+
 def tally_all(PP, public_seed, BB):
-    B0, b = gen_public_b(PP, public_seed)
-    res = [0] * PP.npoly
+    B0, b = _public_b_ntt(PP, public_seed)
+    res = RingArray(PP, evals=np.zeros((PP.npoly, PP.d), dtype=np.int64))
     for a_id, tally in BB.all_tallies():
         zero, x = _extract_authority_result(PP, B0, b, tally)
         if _check_zero(PP, zero):
             raise Exception(f"autority {a_id} is cheating!")
 
-        for i in range(PP.npoly):
-            res[i] += x[i]
+        res = res + x
     return _res_to_list_of_candidates(PP, res)
 
 
-def _check_ballot_vproof(PP, ballot, public_seed):
-    T0, T1 = ballot.com
-    t0 = list(sum(T0[j][i] for j in range(PP.Na)) for i in range(PP.kappa))
-    t1 = list(sum(T1[j][i] for j in range(PP.Na)) for i in range(PP.npoly))
-    return verify_v(PP, ballot.vproof, (t0, t1), ballot.additional_com, public_seed)
+# results of verify_v of all ballots: known verdicts are taken from the
+# verification cache, the other ballots are checked in batches, in worker
+# processes if set_ballot_check_processes was called
+def _check_ballot_vproofs(PP, ballots, public_seed):
+    ballots = list(ballots)
+    digests = list(ballot_digest(PP, public_seed, ballot) for ballot in ballots)
+    res = cached_verdicts(digests)
+    todo = list(n for n, v in enumerate(res) if v is None)
+    todo_ballots = list(ballots[n] for n in todo)
+    if _ballot_check_processes > 1 and len(todo) > 1:
+        verdicts = _verify_ballots_parallel(PP, todo_ballots, public_seed)
+    else:
+        verdicts = _verify_ballots(PP, todo_ballots, public_seed)
+    for n, v in zip(todo, verdicts):
+        res[n] = v
+    store_verdicts((digests[n], res[n]) for n in todo)
+    return res
+
+
+def _verify_ballots(PP, ballots, public_seed):
+    statements = []
+    for ballot in ballots:
+        T0, T1 = ballot.com
+        t0 = list(sum(T0[j][i] for j in range(PP.Na)) for i in range(PP.kappa))
+        t1 = list(sum(T1[j][i] for j in range(PP.Na)) for i in range(PP.npoly))
+        statements.append((ballot.vproof, (t0, t1), ballot.additional_com))
+    return verify_v_batch(PP, statements, public_seed)
+
+
+# most ballots checked by one task of a worker process
+BALLOT_CHECK_CHUNK = 16
+
+_ballot_check_processes = 1
+
+
+# Number of worker processes of testballots and verify, see
+# params.worker_pool
+def set_ballot_check_processes(n):
+    global _ballot_check_processes
+    _ballot_check_processes = n
+    shutdown_worker_pool("ballot_check")
+
+
+# verdicts in the order of ballots, pool.map keeps the order of the chunks
+def _verify_ballots_parallel(PP, ballots, public_seed):
+    size = min(BALLOT_CHECK_CHUNK, -(-len(ballots) // _ballot_check_processes))
+    # only what the check reads is sent to the workers
+    ballots = list(
+        Ballot(None, b.vproof, b.com, b.additional_com, None, None) for b in ballots
+    )
+    chunks = list(ballots[i : i + size] for i in range(0, len(ballots), size))
+    pool = worker_pool("ballot_check", PP, public_seed, _ballot_check_processes)
+    res = []
+    for verdicts in pool.map(_verify_ballots_job, chunks):
+        res += verdicts
+    return res
+
+
+def _verify_ballots_job(ballots):
+    PP, public_seed = worker_params()
+    return _verify_ballots(PP, ballots, public_seed)
 
 
 def verify(PP, result, public_seed, BB):
-    B0, b = gen_public_b(PP, public_seed)
+    B0, b = _public_b_ntt(PP, public_seed)
     T0_a = []
     T1_a = []
     for i in range(PP.Na):
         T0_a.append(list())
         T1_a.append(list())
 
-    for v_id, ballot in BB.correct_ballots():
+    ballots = list(BB.correct_ballots())
+    vproof_res = _check_ballot_vproofs(PP, (b for _, b in ballots), public_seed)
+    for (v_id, ballot), ok in zip(ballots, vproof_res):
         T0, T1 = ballot.com
         for i in range(PP.Na):
             T0_a[i].append(T0[i])
             T1_a[i].append(T1[i])
-        if _check_ballot_vproof(PP, ballot, public_seed):
+        if ok:
             print(f"voter {v_id} is cheating!")
             return 1
     j = 0
-    res = [0] * PP.npoly
+    res = RingArray(PP, evals=np.zeros((PP.npoly, PP.d), dtype=np.int64))
     for a_id, tally in BB.all_tallies():
         if verify_sum_of_commitments(
             PP,
@@ -200,8 +337,7 @@ def verify(PP, result, public_seed, BB):
         if _check_zero(PP, zero):
             print(f"autority {a_id} is cheating!")
             return 1
-        for i in range(PP.npoly):
-            res[i] += x[i]
+        res = res + x
     if _res_to_list_of_candidates(PP, res) != result:
         print("results are wrong!")
         return 1